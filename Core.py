@@ -1,15 +1,33 @@
 from __future__ import unicode_literals
 import re
 import json
-import string 
 from abc import ABCMeta, abstractmethod
 from six import add_metaclass
 import os
+import sys
 from os import system
 import platform
 import datetime
 import numpy as np
 import time
+import itertools
+import hashlib
+import zlib
+import tempfile
+import contextlib
+import random
+import multiprocessing
+import argparse
+import asyncio
+import signal
+import threading
+import bisect
+import logging
+import concurrent.futures
+from multiprocessing import shared_memory
+import collections
+import functools
+from collections import OrderedDict, Counter
 
 @add_metaclass(ABCMeta)
 class StemmerI(object):
@@ -145,14 +163,26 @@ class liOS_Stemmer(StemmerI):
         "zy1s.",  # -yz > -ys
     )
     
-    def __init__(self, rule_tuple=None, strip_prefix_flag=False):
+    # Grammar of a single rule; checked once per rule when the table is compiled
+    rule_pattern = re.compile("^([a-z]+)(\\*?)(\\d)([a-z]*)([>\\.]?)$")
+
+    # Number of stemmed words remembered between calls
+    default_cache_size = 65536
+
+    def __init__(self, rule_tuple=None, strip_prefix_flag=False, cache_size=None):
         """Create an instance of the Lancaster stemmer."""
         # Setup an empty rule dictionary - this will be filled in later
         self.rule_dictionary = {}
+        # Compiled form of rule_dictionary, see parseRules
+        self._rule_table = {}
         # Check if a user wants to strip prefix
         self._strip_prefix = strip_prefix_flag
         # Check if a user wants to use his/her own rule tuples.
         self._rule_tuple = rule_tuple if rule_tuple else self.default_rule_tuple
+        # Bounded LRU cache of word -> stem, a size of 0 disables it.
+        # functools.lru_cache is safe to share between threads.
+        self._cache_size = self.default_cache_size if cache_size is None else cache_size
+        self._cache = functools.lru_cache(maxsize=self._cache_size)(self._stem) if self._cache_size else None
     
     def parseRules(self, rule_tuple=None):
         """Validate the set of rules used in this stemmer.
@@ -160,40 +190,103 @@ class liOS_Stemmer(StemmerI):
         If this function is called as an individual method, without using stem
         method, rule_tuple argument will be compiled into self.rule_dictionary.
         If this function is called within stem, self._rule_tuple will be used.
+
+        Every rule is also compiled into self._rule_table, keyed by the letter
+        it applies to, as (ending, intact_flag, remove_total, append_string,
+        stop_flag) tuples with the ending already reversed.
         """
         # If there is no argument for the function, use class' own rule tuple.
         rule_tuple = rule_tuple if rule_tuple else self._rule_tuple
-        valid_rule = re.compile("^[a-z]+\*?\d[a-z]*[>\.]?$")
-        # Empty any old rules from the rule set before adding new ones
-        self.rule_dictionary = {}
+        # Build the new rules aside, so concurrent stem() calls never see half a rule set
+        rule_dictionary = {}
+        rule_table = {}
 
         for rule in rule_tuple:
-            if not valid_rule.match(rule):
+            rule_match = self.rule_pattern.match(rule)
+            if not rule_match:
                 raise ValueError("The rule {0} is invalid".format(rule))
+            (
+                ending_string,
+                intact_flag,
+                remove_total,
+                append_string,
+                cont_flag,
+            ) = rule_match.groups()
+            compiled_rule = (
+                ending_string[::-1],
+                bool(intact_flag),
+                int(remove_total),
+                append_string,
+                cont_flag == '.',
+            )
             first_letter = rule[0:1]
-            if first_letter in self.rule_dictionary:
-                self.rule_dictionary[first_letter].append(rule)
+            if first_letter in rule_dictionary:
+                rule_dictionary[first_letter].append(rule)
+                rule_table[first_letter].append(compiled_rule)
             else:
-                self.rule_dictionary[first_letter] = [rule]
+                rule_dictionary[first_letter] = [rule]
+                rule_table[first_letter] = [compiled_rule]
+
+        # Replace any old rules, the table first as stem() checks the dictionary
+        self._rule_table = rule_table
+        self.rule_dictionary = rule_dictionary
+        # and forget the stems made with them
+        if self._cache is not None:
+            self._cache.cache_clear()
+
     def stem(self, word):
         """Stem a word using the Lancaster stemmer."""
-        # Lower-case the word, since all the rules are lower-cased
-        word = word.lower()
-        word = self.__stripPrefix(word) if self._strip_prefix else word
+        if self._cache is not None:
+            return self._cache(word)
+        return self._stem(word)
 
-        # Save a copy of the original word
-        intact_word = word
+    def _stem(self, word):
+        # Lower-case the word, since all the rules are lower-cased
+        stemmed = word.lower()
+        stemmed = self.__stripPrefix(stemmed) if self._strip_prefix else stemmed
 
         # If rule dictionary is empty, parse rule tuple.
         if not self.rule_dictionary:
             self.parseRules()
 
-        return self.__start_stemming(word, intact_word)
+        # The original word is passed along as the intact copy
+        stemmed = self.__start_stemming(stemmed, stemmed)
+        return stemmed
+
+    def fingerprint(self):
+        """Return a digest of the rules and options, which decide the stem of every word."""
+        if not self.rule_dictionary:
+            self.parseRules()
+        rules = sorted(self.rule_dictionary.items())
+        return hashlib.sha256(json.dumps([rules, self._strip_prefix]).encode('utf-8')).hexdigest()
+
+    def cache_info(self):
+        """Return the hit/miss counters and occupancy of the stem cache."""
+        info = self._cache.cache_info() if self._cache is not None else None
+        return {
+            'hits': info.hits if info else 0,
+            'misses': info.misses if info else 0,
+            'size': info.currsize if info else 0,
+            'maxsize': self._cache_size,
+        }
+
+    @property
+    def cache_hits(self):
+        return self.cache_info()['hits']
+
+    @property
+    def cache_misses(self):
+        return self.cache_info()['misses']
+
+    def cache_clear(self):
+        """Forget every cached stem and reset the counters."""
+        if self._cache is not None:
+            self._cache.cache_clear()
     
     def __start_stemming(self, word, intact_word):
         """Perform the actual word stemming"""
 
-        valid_rule = re.compile("^([a-z]+)(\*?)(\d)([a-z]*)([>\.]?)$")
+        rule_table = self._rule_table
         proceed = True
         while proceed:
             # Find the position of the last letter of the word to be stemmed
@@ -202,49 +295,41 @@ class liOS_Stemmer(StemmerI):
             # Only stem the word if it has a last letter and a rule matching that last letter
             if (
                 last_letter_position < 0
-                or word[last_letter_position] not in self.rule_dictionary
+                or word[last_letter_position] not in rule_table
             ):
                 proceed = False
             else:
                 rule_was_applied = False
 
                 # Go through each rule that matches the word's final letter
-                for rule in self.rule_dictionary[word[last_letter_position]]:
-                    rule_match = valid_rule.match(rule)
-                    if rule_match:
-                        (
-                            ending_string,
-                            intact_flag,
-                            remove_total,
-                            append_string,
-                            cont_flag,
-                        ) = rule_match.groups()
-
-                        # Convert the number of chars to remove when stemming
-                        # from a string to an integer
-                        remove_total = int(remove_total)
-
-                        # Proceed if word's ending matches rule's word ending
-                        if word.endswith(ending_string[::-1]):
-                            if intact_flag:
-                                if word == intact_word and self.__isAcceptable(
-                                    word, remove_total
-                                ):
-                                    word = self.__applyRule(
-                                        word, remove_total, append_string
-                                    )
-                                    rule_was_applied = True
-                                    if cont_flag == '.':
-                                        proceed = False
-                                    break
-                            elif self.__isAcceptable(word, remove_total):
+                for (
+                    ending_string,
+                    intact_flag,
+                    remove_total,
+                    append_string,
+                    stop_flag,
+                ) in rule_table[word[last_letter_position]]:
+                    # Proceed if word's ending matches rule's word ending
+                    if word.endswith(ending_string):
+                        if intact_flag:
+                            if word == intact_word and self.__isAcceptable(
+                                word, remove_total
+                            ):
                                 word = self.__applyRule(
                                     word, remove_total, append_string
                                 )
                                 rule_was_applied = True
-                                if cont_flag == '.':
+                                if stop_flag:
                                     proceed = False
                                 break
+                        elif self.__isAcceptable(word, remove_total):
+                            word = self.__applyRule(
+                                word, remove_total, append_string
+                            )
+                            rule_was_applied = True
+                            if stop_flag:
+                                proceed = False
+                            break
                 # If no rules apply, the word doesn't need any more stemming
                 if rule_was_applied == False:
                     proceed = False
@@ -269,6 +354,9 @@ class liOS_Stemmer(StemmerI):
 
     def __getLastLetter(self, word):
         """Get the zero-based index of the last alphabetic character in this string."""
+        # Fast path for the common case of a purely alphabetic word
+        if word.isalpha():
+            return len(word) - 1
         last_letter = -1
         for position in range(len(word)):
             if word[position].isalpha():
@@ -314,127 +402,691 @@ class liOS_Stemmer(StemmerI):
 
 stemmer = liOS_Stemmer()
 
+# a token is a run of word characters, with apostrophes allowed inside ("can't")
+TOKEN_PATTERN = re.compile(r"\w+(?:'\w+)*", re.UNICODE)
+
+# characters read from a file at a time by tokenize('file', ...)
+TOKENIZE_CHUNK_SIZE = 1 << 16
+
+def iter_tokens(content, lowercase=True):
+	'''yields the tokens of a string in one pass, lower-cased and without punctuation'''
+	if lowercase:
+		content = content.lower()
+	for match in TOKEN_PATTERN.finditer(content):
+		yield match.group()
+
+def iter_file_tokens(path, lowercase=True, chunk_size=TOKENIZE_CHUNK_SIZE):
+	'''yields the tokens of a file, reading it chunk_size characters at a time'''
+	with open(path, 'r') as word_list:
+		tail = ''
+		while True:
+			chunk = word_list.read(chunk_size)
+			content = tail + chunk
+			if chunk:
+				# tokens never span whitespace, so everything before the last one is complete
+				cut = max(content.rfind(' '), content.rfind('\n'), content.rfind('\t'))
+				if cut < 0:
+					tail = content
+					continue
+				content, tail = content[:cut], content[cut:]
+			for token in iter_tokens(content, lowercase):
+				yield token
+			if not chunk:
+				return
+
 def tokenize(content_type, content):
-	'''takes in list of word, returns a dictionary with words as key, and frequency of word as value'''
-	if content_type is 'file':
-		frequency = {}
-		frequency_v = list(frequency.values())
-		frequency_k = list(frequency.keys())
-		word_list = open(content, 'r')
-		for word in word_list.readlines():
-			if word not in frequency:
-				frequency[word] = 0
-				frequency_v = list(frequency.values())
-				frequency_k = list(frequency.keys())
-			frequency[word] += 1
-		return frequency_v
-	elif content_type is 'string':
-		final_content = content.split(' ')
-		for words in content:
-			words.replace(string.punctuation,'')
-		
-		#[re.sub(r'[^\w\s]','',word) for word in content.split(' ')]
-		#[word.strip(string.punctuation) for word in content.split(' ')]
-		
-		return final_content
+	'''takes in a string or a file path; returns the list of tokens of a string, or a Counter with the frequency of every token in a file'''
+	if content_type == 'file':
+		# the file is streamed, memory only grows with the number of distinct words
+		return Counter(iter_file_tokens(content))
+	elif content_type == 'string':
+		return TOKEN_PATTERN.findall(content.lower())
 	else:
 		print('please set the content type as ”file” or ”string”.')
 		return 0
 
 # classes of training data
 class json_utils():
+	# characters read from a training data file at a time
+	chunk_size = 1 << 16
+	
 	def __init__(self):
 		return
 	
 	def get_training_data(self, file):
+		return list(self.iter_training_data(file))
+	
+	def iter_training_data(self, file):
+		'''yields the training records of a JSONL file or a {"dataObjects": [...]} file one at a time'''
 		with open(file) as training_data:
-			training_dataJSON = json.load(training_data)
 			# set the data id helper to 1, unlike common arrays
 			d_id_helper = 1
 			
-			# define the final training data to return
-			final_training_data = []
-			
-			# loop through training_dataJSON to create an list object
-			for data in training_dataJSON['dataObjects']:
+			for data in self.__iter_objects(training_data):
+				if not isinstance(data, dict) or 'class' not in data or 'sentence' not in data:
+					raise ValueError("Record {0} of {1} has no class and sentence, expected JSON lines or a {{\"dataObjects\": [...]}} object".format(d_id_helper, file))
 				# retrive the variables from the dataObjects
-				d_id, d_class, d_content = data['id'], data['class'], data['sentence']
+				d_id, d_class, d_content = data.get('id', ''), data['class'], data['sentence']
 				
 				# if the id is not defined, define it
 				if d_id == '': 
 					d_id = d_id_helper
 				d_id_helper += 1
 				
-				# put all the retrived variables into an array
-				tmp_data_array = {"id":d_id, "class":d_class, "sentence":d_content}
-				final_training_data.append(tmp_data_array)
-			return final_training_data
+				yield {"id":d_id, "class":d_class, "sentence":d_content}
+	
+	def __iter_objects(self, stream):
+		'''decodes the records of stream incrementally, holding at most one record and one chunk
+		
+		stream holds either JSON lines of records, or one object with the array
+		of records under its "dataObjects" key, next to any other keys
+		'''
+		decoder = json.JSONDecoder()
+		buffer = ''
+		position = 0
+		
+		def fill():
+			# keep the undecoded tail and read the next chunk, False at the end of the file
+			nonlocal buffer, position
+			chunk = stream.read(self.chunk_size)
+			buffer = buffer[position:] + chunk
+			position = 0
+			return bool(chunk)
+		
+		def peek(skip=''):
+			# the next character that is not whitespace or in skip, '' at the end of the file
+			nonlocal position
+			while True:
+				while position < len(buffer) and (buffer[position].isspace() or buffer[position] in skip):
+					position += 1
+				if position < len(buffer) or not fill():
+					return buffer[position:position + 1]
+		
+		def value():
+			# decode the next value, reading chunks until it is complete
+			nonlocal position
+			peek()
+			while True:
+				try:
+					data, end = decoder.raw_decode(buffer, position)
+				except ValueError:
+					if not fill():
+						raise
+					continue
+				# a number cut by the end of the chunk decodes to its prefix, 12 of 12.75,
+				# so it is complete only once whitespace or a delimiter follows it
+				if end < len(buffer) and (not buffer[end - 1].isdigit() or buffer[end].isspace() or buffer[end] in ',:]}'):
+					position = end
+					return data
+				if not fill():
+					position = end
+					return data
+		
+		def expect(character, message):
+			nonlocal position
+			if peek() != character:
+				raise ValueError(message)
+			position += 1
+		
+		if peek() == '{':
+			# either the dataObjects layout or the first of JSON lines, told apart by its keys
+			position += 1
+			record = {}
+			found = False
+			while peek(',') not in ('}', ''):
+				key = value()
+				expect(':', "Expected ':' after the key {0!r}".format(key))
+				if key == 'dataObjects' and not found and peek() == '[':
+					found = True
+					position += 1
+					while peek(',') not in (']', ''):
+						yield value()
+					expect(']', "The dataObjects array is not closed")
+				else:
+					record[key] = value()
+			expect('}', "The first object of the training data is not closed")
+			if found:
+				return
+			yield record
+		while peek():
+			yield value()
 		
 json_utils = json_utils()
-training_data = json_utils.get_training_data('training_data.json')
-print("%s sentences in training data" % len(training_data))
-
-words = []
-classes = []
-documents = []
-ignore_words = ['?']
-# loop through each sentence in our training data
-for pattern in training_data:
-    # tokenize each word in the sentence
-    w = tokenize('string', pattern['sentence'])
-    words.extend(w)
-    
-    # add to documents in our corpus
-    documents.append((w, pattern['class']))
-    if pattern['class'] not in classes:
-        classes.append(pattern['class'])
-
-# stem and lower each word and remove duplicates
-words = [stemmer.stem(w.lower()) for w in words if w not in ignore_words]
-words = list(set(words))
-
-# remove duplicates
-classes = list(set(classes))
-
-print("Documents:", str(len(documents)))
-print("Classes:", str(len(classes)), classes)
-print("USW:", str(len(words)), words)
-
-# create our training data
-training = []
-output = []
-# create an empty array for our output
-output_empty = [0] * len(classes)
-
-# training set, bag of words for each sentence
-for doc in documents:
-    # initialize our bag of words
-    bag = []
-    
-    # list of tokenized words for the pattern
-    pattern_words = doc[0]
-    
-    # stem each word
-    pattern_words = [stemmer.stem(word.lower()) for word in pattern_words]
-    # create our bag of words array
-    for w in words:
-        bag.append(1) if w in pattern_words else bag.append(0)
 
-    training.append(bag)
-    
-    # output is a '0' for each tag and '1' for current tag
-    output_row = list(output_empty)
-    output_row[classes.index(doc[1])] = 1
-    output.append(output_row)
-    
-# sample training/output
-i = 0
-w = documents[i][0]
-print("\nSample Training/output")
-print([stemmer.stem(word.lower()) for word in w])
-print(training[i])
-print(output[i])
+# maps every stem of the corpus to its column in the bag of words
+class Vocabulary(object):
+    def __init__(self, words=()):
+        self.words = []
+        self.index = {}
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        """Add a stem to the vocabulary if needed and return its column."""
+        column = self.index.get(word)
+        if column is None:
+            column = len(self.words)
+            self.index[word] = column
+            self.words.append(word)
+        return column
+
+    def __len__(self):
+        return len(self.words)
+
+    def name(self, column):
+        """Return the stem of a column."""
+        return self.words[column]
+
+    def __contains__(self, word):
+        return word in self.index
+
+    def __iter__(self):
+        return iter(self.words)
+
+    def indices(self, stems):
+        """Return the sorted, unique columns of the stems found in the vocabulary."""
+        index = self.index
+        columns = {index[s] for s in stems if s in index}
+        return np.array(sorted(columns), dtype=np.intp)
+
+    def decode(self, columns):
+        """Return the (columns, signs) of an array of columns, see HashingVocabulary.decode()."""
+        # every column counts 1
+        return np.asarray(columns, dtype=np.intp), None
+
+    def vectorize(self, stems, sparse=False):
+        """Return the bag of words of a list of stems.
+
+        With sparse=True only the active column indices are returned,
+        otherwise a dense 0/1 array as wide as the vocabulary.
+        """
+        columns = self.indices(stems)
+        if sparse:
+            return columns
+        bag = np.zeros(len(self.words), dtype=int)
+        bag[columns] = 1
+        return bag
+
+    def from_indices(self, columns_list, dtype=int):
+        """Return the dense bag of words matrix of several arrays of active columns."""
+        bags = np.zeros((len(columns_list), len(self.words)), dtype=dtype)
+        for row, columns in enumerate(columns_list):
+            bags[row, columns] = 1
+        return bags
+
+    def matrix(self, stem_lists, dtype=int):
+        """Return the dense bag of words matrix of several lists of stems."""
+        stem_lists = list(stem_lists)
+        bags = np.zeros((len(stem_lists), len(self.words)), dtype=dtype)
+        for row, stems in enumerate(stem_lists):
+            bags[row, self.indices(stems)] = 1
+        return bags
+
+    def __repr__(self):
+        return '<Vocabulary %s words>' % len(self.words)
+
+# default number of columns of a HashingVocabulary
+HASHING_DIMENSION = 1 << 12
+
+# maps every stem and n-gram to one of a fixed number of columns by its hash
+class HashingVocabulary(object):
+    """Bag of words over a fixed number of hashed columns.
+
+    The same interface as Vocabulary, but no words are kept: a feature is
+    hashed to its column, so the input layer and the cost of a request do
+    not grow with the corpus. Besides the stems themselves, every run of
+    2 to ngrams consecutive stems is a feature too. With signed, half of
+    the features count -1 instead of 1 so collisions tend to cancel out.
+
+    Signed features are returned by indices() as the code -(column + 1).
+    """
+
+    def __init__(self, dimension=HASHING_DIMENSION, ngrams=1, signed=False):
+        if dimension < 1 or ngrams < 1:
+            raise ValueError("Invalid hashing dimension {0} or ngrams {1}".format(dimension, ngrams))
+        self.dimension = dimension
+        self.ngrams = ngrams
+        self.signed = signed
+        # there are no words to save with the model
+        self.words = []
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['dimension'], config['ngrams'], config['signed'])
+
+    def config(self):
+        """Return the settings saved with the model, see from_config()."""
+        return {'type': 'hashing', 'dimension': self.dimension, 'ngrams': self.ngrams, 'signed': self.signed}
+
+    def features(self, stems):
+        """Yield the unigram and n-gram features of a list of stems."""
+        stems = list(stems)
+        for n in range(1, self.ngrams + 1):
+            for i in range(len(stems) - n + 1):
+                yield ' '.join(stems[i:i + n])
+
+    def code(self, feature):
+        # crc32 rather than hash(), which is salted per process
+        h = zlib.crc32(feature.encode('utf-8')) & 0xffffffff
+        column = h % self.dimension
+        if self.signed and h & 0x80000000:
+            return -(column + 1)
+        return column
+
+    def __len__(self):
+        return self.dimension
+
+    def name(self, code):
+        """Return a readable name of a code, hashing cannot be reversed."""
+        return '%s#%s' % ('-' if code < 0 else '', code if code >= 0 else -code - 1)
+
+    def indices(self, stems):
+        """Return the sorted, unique codes of the features of the stems."""
+        return np.array(sorted({self.code(f) for f in self.features(stems)}), dtype=np.intp)
+
+    def decode(self, codes):
+        """Return the (columns, signs) of an array of codes, signs is None when all are 1."""
+        codes = np.asarray(codes, dtype=np.intp)
+        if not self.signed:
+            return codes, None
+        negative = codes < 0
+        return np.where(negative, -codes - 1, codes), np.where(negative, -1, 1)
+
+    def vectorize(self, stems, sparse=False):
+        """Return the hashed bag of words of a list of stems, see Vocabulary.vectorize()."""
+        codes = self.indices(stems)
+        if sparse:
+            return codes
+        return self.from_indices([codes])[0]
+
+    def from_indices(self, codes_list, dtype=int):
+        """Return the dense bag of words matrix of several arrays of codes."""
+        bags = np.zeros((len(codes_list), self.dimension), dtype=dtype)
+        for row, codes in enumerate(codes_list):
+            columns, signs = self.decode(codes)
+            # colliding features add up
+            np.add.at(bags[row], columns, 1 if signs is None else signs)
+        return bags
+
+    def matrix(self, stem_lists, dtype=int):
+        """Return the dense bag of words matrix of several lists of stems."""
+        return self.from_indices([self.indices(stems) for stems in stem_lists], dtype)
+
+    def __repr__(self):
+        return '<HashingVocabulary %s columns, %s-grams%s>' % (
+            self.dimension, self.ngrams, ', signed' if self.signed else '')
+
+def model_vocabulary(model):
+    """Return the Vocabulary or HashingVocabulary the synapses of a model were trained with."""
+    if model.get('vectorizer'):
+        return HashingVocabulary.from_config(model['vectorizer'])
+    return Vocabulary(model['words'])
+
+# bags of words in CSR form, for a first layer that only touches active columns
+class SparseBags(object):
+    """Rows of bags of words stored as their active columns only.
+
+    The active columns of row i are indices[indptr[i]:indptr[i + 1]] with
+    the matching values, or 1 when values is None. dot() gathers and sums
+    the weight rows of the active columns and transpose_dot() scatters a
+    gradient back to only those rows, so the first layer costs the number
+    of active tokens rather than the vocabulary width.
+    """
+
+    def __init__(self, indptr, indices, values, width):
+        self.indptr = np.asarray(indptr, dtype=np.intp)
+        self.indices = np.asarray(indices, dtype=np.intp)
+        # None for binary bags, which need no multiplication
+        self.values = values
+        self.width = width
+        self._transpose = None
+
+    @classmethod
+    def from_indices(cls, columns_list, width, vocabulary=None):
+        """Return the bags of several arrays of active columns, or of codes decoded by vocabulary."""
+        indptr = np.fromiter(itertools.accumulate(map(len, columns_list), initial=0),
+                             dtype=np.intp, count=len(columns_list) + 1)
+        indices = np.concatenate(columns_list) if len(columns_list) else np.zeros(0, dtype=np.intp)
+        values = None
+        if vocabulary is not None:
+            indices, values = vocabulary.decode(indices)
+        return cls(indptr, indices, values, width)
+
+    @classmethod
+    def from_dense(cls, X):
+        """Return the bags of the nonzero entries of a dense matrix."""
+        X = np.asarray(X)
+        rows, columns = np.nonzero(X)
+        indptr = np.zeros(len(X) + 1, dtype=np.intp)
+        np.cumsum(np.bincount(rows, minlength=len(X)), out=indptr[1:])
+        values = X[rows, columns]
+        return cls(indptr, columns, None if np.all(values == 1) else values, X.shape[1])
+
+    @property
+    def shape(self):
+        return (len(self.indptr) - 1, self.width)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, rows):
+        """Return the bags of an array of row numbers."""
+        rows = np.asarray(rows, dtype=np.intp)
+        starts, ends = self.indptr[rows], self.indptr[rows + 1]
+        indptr = np.zeros(len(rows) + 1, dtype=np.intp)
+        np.cumsum(ends - starts, out=indptr[1:])
+        # positions of the active columns of every row, in row order
+        lengths = ends - starts
+        take = np.arange(indptr[-1], dtype=np.intp) + np.repeat(starts - indptr[:-1], lengths)
+        values = self.values[take] if self.values is not None else None
+        return SparseBags(indptr, self.indices[take], values, self.width)
+
+    def toarray(self, dtype=int):
+        """Return the dense matrix of the bags."""
+        X = np.zeros(self.shape, dtype=dtype)
+        rows = np.repeat(np.arange(len(self)), np.diff(self.indptr))
+        np.add.at(X, (rows, self.indices), 1 if self.values is None else self.values)
+        return X
+
+    def dot(self, synapse, dtype=None):
+        """Return the bags times synapse, summed in dtype (that of synapse by default)."""
+        dtype = dtype or synapse.dtype
+        if not len(self.indices):
+            return np.zeros((len(self), synapse.shape[1]), dtype=dtype)
+        weights = synapse[self.indices].astype(dtype, copy=False)
+        if self.values is not None:
+            weights = weights * self.values[:, None].astype(dtype)
+        if len(self) == 1:
+            return weights.sum(axis=0, keepdims=True)
+        # the columns of every row are contiguous, sum each run of them
+        layer = np.zeros((len(self), synapse.shape[1]), dtype=dtype)
+        lengths = np.diff(self.indptr)
+        nonempty = lengths > 0
+        layer[nonempty] = np.add.reduceat(weights, self.indptr[:-1][nonempty], axis=0)
+        return layer
+
+    def _transpose_layout(self):
+        if self._transpose is None:
+            # group the entries by column once, the layout is the same every epoch
+            order = np.argsort(self.indices, kind='stable')
+            columns, starts = np.unique(self.indices[order], return_index=True)
+            rows = np.repeat(np.arange(len(self)), np.diff(self.indptr))[order]
+            values = self.values[order][:, None] if self.values is not None else None
+            self._transpose = (columns, starts, rows, values)
+        return self._transpose
+
+    def active_columns(self):
+        """Return the sorted columns active in any row."""
+        return self._transpose_layout()[0]
+
+    def transpose_dot(self, delta):
+        """Return (columns, rows) where rows are the nonzero rows of bags.T times delta.
+
+        columns are active_columns() and every other row of the product is
+        zero, so a gradient is applied with synapse[columns] += rows.
+        """
+        columns, starts, rows, values = self._transpose_layout()
+        if not len(columns):
+            return columns, np.zeros((0, delta.shape[1]), dtype=delta.dtype)
+        contributions = delta[rows]
+        if values is not None:
+            contributions *= values.astype(delta.dtype)
+        return columns, np.add.reduceat(contributions, starts, axis=0)
+
+    def __repr__(self):
+        return '<SparseBags %sx%s, %s active>' % (len(self), self.width, len(self.indices))
+
+######################################################
+# Entities
+#
+# dictionary.json maps slots such as ":person:" to the phrases that can
+# fill them. EntityMatcher finds those phrases in sentences and
+# expand_templates fills the slots of training sentences with them.
+
+# default slot dictionary
+DICTIONARY_FILE = 'dictionary.json'
+
+# a slot in a training sentence, e.g. ":object:"
+SLOT_PATTERN = re.compile(r':\w+:', re.UNICODE)
+
+def load_dictionary(path=DICTIONARY_FILE):
+    """Return the {slot: [phrase, ...]} dictionary stored at path."""
+    with open(path) as data_file:
+        return json.load(data_file)
+
+class EntityMatcher(object):
+    """Aho-Corasick automaton over tokens finding every dictionary phrase in one pass.
+
+    Phrases are matched on whole tokens, so "hat" is not found inside
+    "that", and multi-word phrases such as "quantum computer" are found
+    wherever their tokens appear consecutively, overlapping or not.
+    """
+
+    def __init__(self, dictionary=None):
+        # state -> {token: next state}, failure link, phrases ending there and
+        # those plus the phrases ending at the failure states
+        self._goto = [{}]
+        self._fail = [0]
+        self._phrases = [[]]
+        self._output = [[]]
+        self._built = True
+        for slot, phrases in (dictionary or {}).items():
+            for phrase in phrases:
+                self.add(phrase, slot)
+        self.build()
+
+    def add(self, phrase, slot):
+        tokens = list(iter_tokens(phrase))
+        if not tokens:
+            return
+        state = 0
+        for token in tokens:
+            next_state = self._goto[state].get(token)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._phrases.append([])
+                self._output.append([])
+                self._goto[state][token] = next_state
+            state = next_state
+        self._phrases[state].append((slot, phrase, len(tokens)))
+        self._built = False
+
+    def build(self):
+        """Compute the failure links, breadth first from the root."""
+        goto, fail = self._goto, self._fail
+        queue = collections.deque(goto[0].values())
+        for state in queue:
+            fail[state] = 0
+            self._output[state] = list(self._phrases[state])
+        while queue:
+            state = queue.popleft()
+            for token, next_state in goto[state].items():
+                queue.append(next_state)
+                fallback = fail[state]
+                while fallback and token not in goto[fallback]:
+                    fallback = fail[fallback]
+                fail[next_state] = goto[fallback].get(token, 0)
+                self._output[next_state] = self._phrases[next_state] + self._output[fail[next_state]]
+        self._built = True
+
+    def match(self, sentence):
+        """Return every phrase found in sentence as a dict of slot, entity and token span."""
+        if not self._built:
+            self.build()
+        goto, fail, output = self._goto, self._fail, self._output
+        entities = []
+        state = 0
+        for position, token in enumerate(iter_tokens(sentence)):
+            while state and token not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(token, 0)
+            for slot, phrase, length in output[state]:
+                entities.append({'slot': slot, 'entity': phrase,
+                                 'start': position - length + 1, 'end': position + 1})
+        return entities
+
+    def __len__(self):
+        return len(self._goto) - 1
+
+    def __repr__(self):
+        return '<EntityMatcher %s states>' % len(self)
+
+def expand_templates(records, dictionary, max_expansions=None):
+    """Lazily yield training records with their slots filled from dictionary.
+
+    Every combination of phrases is produced on demand, at most
+    max_expansions per record when given, so the Cartesian product is
+    never built. Slots missing from the dictionary are left as they are.
+    """
+    for record in records:
+        parts = SLOT_PATTERN.split(record['sentence'])
+        slots = SLOT_PATTERN.findall(record['sentence'])
+        choices = [dictionary.get(slot, [slot]) for slot in slots]
+        combinations = itertools.product(*choices)
+        if max_expansions is not None:
+            combinations = itertools.islice(combinations, max_expansions)
+        for combination in combinations:
+            sentence = parts[0]
+            for phrase, part in zip(combination, parts[1:]):
+                sentence += phrase + part
+            expanded = dict(record)
+            expanded['sentence'] = sentence
+            yield expanded
+
+######################################################
+# Instrumentation
+#
+# Opt-in timings and counters of the classify and train pipelines. Every
+# call site first checks instrumentation.enabled, so while it is disabled
+# the only cost is that attribute lookup. Metrics go to pluggable sinks
+# with observe/count/gauge methods:
+#
+#   sink = instrumentation.enable()          # in-memory HistogramSink
+#   instrumentation.enable(HistogramSink(), LogSink())
+#   print(sink.prometheus())
+
+class HistogramSink(object):
+    """Keeps every metric in memory as a histogram, counter or gauge."""
+
+    # upper bounds of the histogram buckets, wide enough for seconds and counts
+    buckets = (1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 0.1, 1, 10, 100, 1000, 10000, float('inf'))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, name, value):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = {
+                    'count': 0, 'sum': 0.0, 'min': value, 'max': value, 'buckets': [0] * len(self.buckets)}
+            histogram['count'] += 1
+            histogram['sum'] += value
+            histogram['min'] = min(histogram['min'], value)
+            histogram['max'] = max(histogram['max'], value)
+            histogram['buckets'][bisect.bisect_left(self.buckets, value)] += 1
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def summary(self):
+        """Return the count, mean, min and max of every histogram plus counters and gauges."""
+        with self._lock:
+            summary = {name: {'count': h['count'], 'mean': h['sum'] / h['count'], 'min': h['min'], 'max': h['max']}
+                       for name, h in self.histograms.items()}
+            summary.update(self.counters)
+            summary.update(self.gauges)
+        return summary
+
+    def prometheus(self, prefix='lios'):
+        """Return every metric in the Prometheus text exposition format."""
+        def metric_name(name):
+            return prefix + '_' + re.sub('[^a-zA-Z0-9_]', '_', name)
+
+        lines = []
+        with self._lock:
+            for name, histogram in sorted(self.histograms.items()):
+                name = metric_name(name)
+                lines.append('# TYPE %s histogram' % name)
+                cumulative = 0
+                for bound, count in zip(self.buckets, histogram['buckets']):
+                    cumulative += count
+                    lines.append('%s_bucket{le="%s"} %s' % (name, '+Inf' if bound == float('inf') else repr(bound), cumulative))
+                lines.append('%s_sum %r' % (name, histogram['sum']))
+                lines.append('%s_count %s' % (name, histogram['count']))
+            for name, value in sorted(self.counters.items()):
+                lines.append('# TYPE %s counter' % metric_name(name))
+                lines.append('%s %r' % (metric_name(name), value))
+            for name, value in sorted(self.gauges.items()):
+                lines.append('# TYPE %s gauge' % metric_name(name))
+                lines.append('%s %r' % (metric_name(name), value))
+        return '\n'.join(lines) + '\n'
+
+    def __repr__(self):
+        return '<HistogramSink %s metrics>' % (len(self.histograms) + len(self.counters) + len(self.gauges))
+
+class LogSink(object):
+    """Writes every metric to a logger as it is recorded."""
+
+    def __init__(self, logger=None, level=logging.DEBUG):
+        self.logger = logger if logger is not None else logging.getLogger('lios')
+        self.level = level
+
+    def observe(self, name, value):
+        self.logger.log(self.level, "%s %r", name, value)
+
+    def count(self, name, value=1):
+        self.logger.log(self.level, "%s +%r", name, value)
+
+    def gauge(self, name, value):
+        self.logger.log(self.level, "%s =%r", name, value)
+
+class Instrumentation(object):
+    def __init__(self):
+        self.enabled = False
+        self.sinks = []
+
+    def enable(self, *sinks):
+        """Start recording into sinks, a new HistogramSink if none are given; returns the first sink."""
+        self.sinks = list(sinks) if sinks else [HistogramSink()]
+        self.enabled = True
+        return self.sinks[0]
+
+    def disable(self):
+        self.enabled = False
+        self.sinks = []
+
+    def observe(self, name, value):
+        for sink in self.sinks:
+            sink.observe(name, value)
+
+    def count(self, name, value=1):
+        for sink in self.sinks:
+            sink.count(name, value)
+
+    def gauge(self, name, value):
+        for sink in self.sinks:
+            sink.gauge(name, value)
+
+    def lap(self, name, start):
+        """Observe the seconds since start under name and return the current time."""
+        now = time.perf_counter()
+        self.observe(name, now - start)
+        return now
+
+    def __repr__(self):
+        return '<Instrumentation %s>' % ('enabled' if self.enabled else 'disabled')
 
+instrumentation = Instrumentation()
 
 # compute sigmoid nonlinearity
 def sigmoid(x):
@@ -444,6 +1096,30 @@ def sigmoid(x):
 # convert output of sigmoid function to its derivative
 def sigmoid_output_to_derivative(output):
     return output*(1-output)
+
+# output layers of the network: sigmoid scores every class on its own and is
+# trained on the squared error, softmax spreads one probability over all
+# classes and is trained on the cross-entropy
+OUTPUT_LAYERS = ('sigmoid', 'softmax')
+
+# compute softmax probabilities of every row
+def softmax(x):
+    output = np.exp(x - np.max(x, axis=-1, keepdims=True))
+    output /= np.sum(output, axis=-1, keepdims=True)
+    return output
+
+def output_layer(output):
+    """Return the activation function of an output layer by name."""
+    if output not in OUTPUT_LAYERS:
+        raise ValueError("Unknown output layer {0}, expected one of {1}".format(output, OUTPUT_LAYERS))
+    return softmax if output == 'softmax' else sigmoid
+
+# convert the error of an output layer to its delta
+def output_delta(error, layer, output):
+    if output == 'softmax':
+        # the cross-entropy gradient of softmax is the error itself
+        return error
+    return error * sigmoid_output_to_derivative(layer)
  
 def clean_up_sentence(sentence):
     # tokenize the pattern
@@ -454,63 +1130,463 @@ def clean_up_sentence(sentence):
     return sentence_words
 
 # return BagOfWords array: 0 or 1 for each word in the bag that‘s in the sentence
-def bow(sentence, words, show_details=False):
+def bow(sentence, words, show_details=False, sparse=False):
+    # words may be a plain list of stems or an already built Vocabulary
+    if not isinstance(words, (Vocabulary, HashingVocabulary)):
+        words = Vocabulary(words)
     # tokenize the pattern
     sentence_words = clean_up_sentence(sentence)
     # bag of words
-    bag = [0]*len(words)  
-    for s in sentence_words:
-        for i,w in enumerate(words):
-            if w == s: 
-                bag[i] = 1
-                if show_details:
-                    print ("found in bag: %s" % w)
+    bag = words.vectorize(sentence_words, sparse=sparse)
+    if show_details:
+        for i in (bag if sparse else np.flatnonzero(bag)):
+            print ("found in bag: %s" % words.name(i))
 
-    return(np.array(bag))
+    return(bag)
+
+######################################################
+# Model persistence
+#
+# A model is a directory holding one raw .npy blob per synapse and a small
+# manifest.json with the words, classes, datetime and a checksum of the
+# weights. The blobs are memory-mapped on load so every process using the
+# same model shares one page-cache copy.
+#
+# Blob file names carry the checksum of their model and every file is
+# written to a temporary file and renamed into place, the manifest last.
+# A reader therefore always sees a complete model, old or new.
+#
+# A copy of the manifest of each of the last MODEL_HISTORY models is kept
+# in the versions directory, with their blobs, so they can still be loaded.
+
+# directory the trained model is written to and loaded from
+MODEL_DIR = 'synapses'
+MODEL_FORMAT = 1
+MODEL_MANIFEST = 'manifest.json'
+MODEL_BLOBS = ('synapse0', 'synapse1')
+MODEL_VERSIONS_DIR = 'versions'
+# models kept loadable in model_dir
+MODEL_HISTORY = 5
+
+# legacy model file imported by convert_synapses_json
+SYNAPSE_FILE = 'synapses.json'
+
+@contextlib.contextmanager
+def atomic_write(path, mode='w'):
+    """Open a temporary file next to path and rename it over path once written."""
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as outfile:
+            yield outfile
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def synapse_checksum(synapse_0, synapse_1):
+    checksum = hashlib.sha256()
+    for synapse in (synapse_0, synapse_1):
+        checksum.update(np.ascontiguousarray(synapse))
+    return 'sha256:' + checksum.hexdigest()
+
+def read_manifest(model_dir):
+    """Return the manifest of model_dir, or None if it has no model."""
+    try:
+        with open(os.path.join(model_dir, MODEL_MANIFEST)) as data_file:
+            return json.load(data_file)
+    except IOError:
+        return None
+
+def model_version(manifest):
+    """Return the version of a model: its datetime, and the start of its checksum for models saved the same minute."""
+    return '%s %s' % (manifest['datetime'], manifest['checksum'].split(':')[1][:8])
+
+def list_versions(model_dir):
+    """Return the manifests of the models kept in model_dir, oldest first."""
+    # checksum -> (datetime, time saved, manifest)
+    manifests = {}
+    versions_dir = os.path.join(model_dir, MODEL_VERSIONS_DIR)
+    if os.path.isdir(versions_dir):
+        for filename in os.listdir(versions_dir):
+            if filename.endswith('.json'):
+                path = os.path.join(versions_dir, filename)
+                with open(path) as data_file:
+                    manifest = json.load(data_file)
+                manifests[manifest['checksum']] = (manifest['datetime'], os.path.getmtime(path), manifest)
+    # models saved before versions were kept only have their manifest
+    current = read_manifest(model_dir)
+    if current is not None and current['checksum'] not in manifests:
+        manifests[current['checksum']] = (current['datetime'], os.path.getmtime(os.path.join(model_dir, MODEL_MANIFEST)), current)
+    return [manifest for _, _, manifest in sorted(manifests.values(), key=lambda entry: entry[:2])]
+
+def save_model(model_dir, synapse_0, synapse_1, words, classes, now=None, vectorizer=None, quantization=None,
+               output='sigmoid'):
+    """Atomically write the synapses and their manifest to model_dir.
+
+    vectorizer is the HashingVocabulary the synapses were trained with,
+    None when their rows follow words. quantization describes quantized
+    synapses, see quantize_model(). output is the output layer, one of
+    OUTPUT_LAYERS.
+    """
+    now = now if now else datetime.datetime.now()
+    if not os.path.isdir(model_dir):
+        os.makedirs(model_dir)
+    previous = read_manifest(model_dir)
+    checksum = synapse_checksum(synapse_0, synapse_1)
+    synapses = dict(zip(MODEL_BLOBS, (synapse_0, synapse_1)))
+    files = {name: '%s-%s.npy' % (name, checksum.split(':')[1][:16]) for name in MODEL_BLOBS}
+    for name in MODEL_BLOBS:
+        with atomic_write(os.path.join(model_dir, files[name]), 'wb') as outfile:
+            np.save(outfile, np.ascontiguousarray(synapses[name]))
+
+    manifest = {'format': MODEL_FORMAT,
+                'datetime': now.strftime("%Y-%m-%d %H:%M"),
+                'words': list(words),
+                'classes': list(classes),
+                'files': files,
+                'shapes': {name: list(synapses[name].shape) for name in MODEL_BLOBS},
+                'dtype': str(synapse_0.dtype),
+                'checksum': checksum
+               }
+    if vectorizer is not None:
+        manifest['vectorizer'] = vectorizer.config()
+    if quantization is not None:
+        manifest['quantization'] = quantization
+    # manifests without an output have a sigmoid one
+    if output != 'sigmoid':
+        manifest['output'] = output
+    versions_dir = os.path.join(model_dir, MODEL_VERSIONS_DIR)
+    if not os.path.isdir(versions_dir):
+        os.makedirs(versions_dir)
+    with atomic_write(os.path.join(versions_dir, '%s.json' % checksum.split(':')[1][:16])) as outfile:
+        json.dump(manifest, outfile, indent=4, sort_keys=True)
+    with atomic_write(os.path.join(model_dir, MODEL_MANIFEST)) as outfile:
+        json.dump(manifest, outfile, indent=4, sort_keys=True)
+
+    # forget all but the last MODEL_HISTORY versions
+    versions = sorted((os.path.join(versions_dir, f) for f in os.listdir(versions_dir) if f.endswith('.json')),
+                      key=os.path.getmtime)
+    for filename in versions[:-MODEL_HISTORY]:
+        os.remove(filename)
+    # and drop the blobs of no kept version, except the previous model which readers may still be opening
+    keep = set((previous or {}).get('files', {}).values())
+    for kept in list_versions(model_dir):
+        keep.update(kept['files'].values())
+    for filename in os.listdir(model_dir):
+        if filename.endswith('.npy') and filename.startswith(MODEL_BLOBS) and filename not in keep:
+            os.remove(os.path.join(model_dir, filename))
+    return manifest
+
+def load_model(model_dir, mmap=True, verify=True, manifest=None):
+    """Load a model written by save_model.
+
+    Returns the manifest dict with 'synapse0' and 'synapse1' added. The
+    weights are read-only memory maps unless mmap is False. With verify
+    the weights are checked against the manifest checksum. manifest is
+    that of a kept version to load instead of the current model.
+    """
+    model = read_manifest(model_dir) if manifest is None else dict(manifest)
+    if model is None:
+        raise IOError("No model found in {0}".format(model_dir))
+    if model.get('format') != MODEL_FORMAT:
+        raise ValueError("Unsupported model format {0} in {1}".format(model.get('format'), model_dir))
+    if model.get('output', 'sigmoid') not in OUTPUT_LAYERS:
+        raise ValueError("Unsupported output layer {0} in {1}".format(model['output'], model_dir))
+
+    files = model.get('files', {name: name + '.npy' for name in MODEL_BLOBS})
+    for name in MODEL_BLOBS:
+        synapse = np.load(os.path.join(model_dir, files[name]), mmap_mode='r' if mmap else None)
+        if list(synapse.shape) != model['shapes'][name]:
+            raise ValueError("The {0} weights in {1} do not match the manifest".format(name, model_dir))
+        model[name] = synapse
+
+    inputs = model['vectorizer']['dimension'] if model.get('vectorizer') else len(model['words'])
+    if (model['synapse0'].shape[0] != inputs
+            or model['synapse1'].shape[1] != len(model['classes'])
+            or model['synapse0'].shape[1] != model['synapse1'].shape[0]):
+        raise ValueError("The model in {0} has inconsistent dimensions".format(model_dir))
+    if verify and synapse_checksum(model['synapse0'], model['synapse1']) != model['checksum']:
+        raise ValueError("The model in {0} failed its checksum".format(model_dir))
+    return model
+
+def convert_synapses_json(synapse_file, model_dir):
+    """One-shot import of a legacy synapses.json into the binary model format."""
+    with open(synapse_file) as data_file:
+        synapse = json.load(data_file)
+    now = datetime.datetime.strptime(synapse['datetime'], "%Y-%m-%d %H:%M")
+    return save_model(model_dir,
+                      np.asarray(synapse['synapse0']), np.asarray(synapse['synapse1']),
+                      synapse['words'], synapse['classes'], now)
+
+######################################################
+# Model registry
+#
+# Long-running processes pick up newly trained models without a restart.
+# The model in use is swapped by a single reference assignment: a classify
+# call that already took the old model finishes on it, and readers never
+# take a lock. Loading and verifying a new version happens beforehand, in
+# the background when watching.
+
+# seconds between two looks at the manifest while watching
+MODEL_POLL_INTERVAL = 2.0
+
+class ModelRegistry(object):
+    """The versions of the model kept in model_dir and the one in use."""
+
+    def __init__(self, model_dir=MODEL_DIR):
+        self.model_dir = model_dir
+        # the model in use, None until one is loaded
+        self.current = None
+        # set when a version was chosen explicitly, watching then leaves it in place
+        self.pinned = False
+        self.logger = logging.getLogger('lios')
+        # only serializes loaders, never readers
+        self._activate_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._watcher = None
+
+    def versions(self):
+        """Return the versions that can be loaded, oldest first."""
+        return [model_version(manifest) for manifest in list_versions(self.model_dir)]
+
+    def load(self, version=None):
+        """Load and verify a version, the saved model by default, without using it.
+
+        version may be shortened to its datetime when that is unambiguous.
+        """
+        if version is None:
+            model = load_model(self.model_dir)
+        else:
+            manifests = [m for m in list_versions(self.model_dir) if model_version(m).startswith(version)]
+            if len(manifests) != 1:
+                raise ValueError("{0} models match version {1} in {2}".format(len(manifests), version, self.model_dir))
+            model = load_model(self.model_dir, manifest=manifests[0])
+        model['version'] = model_version(model)
+        # the synapse rows and columns follow the words and classes they were trained with
+        model['vocabulary'] = model_vocabulary(model)
+        if 'scales' in model.get('quantization', {}):
+            model['scales'] = tuple(np.array(model['quantization']['scales'][name], dtype=np.float32)
+                                    for name in MODEL_BLOBS)
+        if 'quantization' in model:
+            # the hidden layer is small, so it is dequantized once here instead of on every forward pass
+            synapse_1 = model['synapse1'].astype(np.float32)
+            if 'scales' in model:
+                synapse_1 *= model['scales'][1]
+            model['synapse1_float32'] = synapse_1
+        return model
+
+    def activate(self, version=None):
+        """Load a version and swap it in, returning it. An explicit version stays until reset()."""
+        with self._activate_lock:
+            model = self.load(version)
+            self.pinned = version is not None
+            self.current = model
+        return model
+
+    def reset(self):
+        """Forget the model in use, the saved one is loaded on next use."""
+        with self._activate_lock:
+            self.pinned = False
+            self.current = None
+
+    def check(self):
+        """Swap in the saved model if it is new, returning whether it was."""
+        manifest = read_manifest(self.model_dir)
+        current = self.current
+        if manifest is None or self.pinned or (current is not None and manifest['checksum'] == current['checksum']):
+            return False
+        model = self.activate()
+        self.logger.info("loaded model %s from %s", model['version'], self.model_dir)
+        return True
+
+    def watch(self, interval=MODEL_POLL_INTERVAL):
+        """Check for a new model every interval seconds in a daemon thread, until stop_watching()."""
+        if self._watcher is not None:
+            return
+        self._stop.clear()
+
+        def poll():
+            while not self._stop.wait(interval):
+                try:
+                    self.check()
+                except (IOError, ValueError) as e:
+                    # keep serving the current model
+                    self.logger.warning("model in %s not reloaded: %s", self.model_dir, e)
+
+        self._watcher = threading.Thread(target=poll, name='lios-model-watch')
+        self._watcher.daemon = True
+        self._watcher.start()
+
+    def stop_watching(self):
+        if self._watcher is not None:
+            self._stop.set()
+            self._watcher.join()
+            self._watcher = None
+
+    def __repr__(self):
+        current = self.current
+        return '<ModelRegistry %s %s>' % (self.model_dir, current['version'] if current is not None else 'not loaded')
 
-def think(sentence, show_details=False):
-    x = bow(sentence.lower(), words, show_details)
-    if show_details:
-        print ("sentence:", sentence, "\n bow:", x)
-    # input layer is our bag of words
-    l0 = x
-    
-    # matrix multiplication of input and hidden layer
-    l1 = sigmoid(np.dot(l0, synapse_0))
-    
-    # output layer
-    l2 = sigmoid(np.dot(l1, synapse_1))
-    return l2
-    
 # Artaficial Neuaral Network (ANN) and Gradient Descent
-def train(X, y, hidden_neurons=10, alpha=1, epochs=50000, dropout=False, dropout_percent=0.5):
 
-    print ("Training with %s neurons, alpha:%s, dropout:%s %s" % (hidden_neurons, str(alpha), dropout, dropout_percent if dropout else ''))
-    print ("Input matrix: %sx%s    Output matrix: %sx%s" % (len(X),len(X[0]),1, len(classes)))
+def one_hot(labels, width, dtype=int):
+    """Return the one-hot rows of a vector of class numbers, width classes wide."""
+    labels = np.asarray(labels)
+    y = np.zeros((len(labels), width), dtype=dtype)
+    y[np.arange(len(labels)), labels] = 1
+    return y
+
+def train(X, y, hidden_neurons=10, alpha=1, epochs=50000, dropout=False, dropout_percent=0.5,
+          words=(), classes=(), model_dir=MODEL_DIR, vectorizer=None, checkpoint_every=None, resume=False,
+          output='sigmoid'):
+    # y may be class numbers, one-hot encoded against classes
+    if np.ndim(y) == 1:
+        y = one_hot(y, len(classes))
+    # with checkpoint_every or resume, progress is kept in model_dir until the model is saved
+    checkpoint = None
+    if checkpoint_every or resume:
+        checkpoint = os.path.join(model_dir, CHECKPOINT_FILE)
+        if not os.path.isdir(model_dir):
+            os.makedirs(model_dir)
+
+    synapse_0, synapse_1 = train_synapses(X, y, hidden_neurons, alpha, epochs, dropout, dropout_percent,
+                                          checkpoint=checkpoint, checkpoint_every=checkpoint_every or CHECKPOINT_EVERY,
+                                          resume=resume, output=output)
+
+    now = datetime.datetime.now()
+
+    # persist synapses
+    save_model(model_dir, synapse_0, synapse_1, words, classes, now, vectorizer, output=output)
+    print ("saved synapses to:", model_dir)
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+######################################################
+# Training checkpoints
+#
+# train_synapses can save its whole state every checkpoint_every epochs:
+# the weights, the previous updates and direction counts, the next epoch,
+# the best error so far and the state of np.random. A run resumed from a
+# checkpoint therefore ends with exactly the weights of an uninterrupted
+# one. Checkpoints are written with atomic_write like models.
+
+# file of the checkpoint kept in model_dir by train()
+CHECKPOINT_FILE = 'checkpoint.npz'
+# epochs between checkpoints
+CHECKPOINT_EVERY = 1000
+
+def checkpoint_fingerprint(X, y, hidden_neurons, alpha, dropout, dropout_percent, output='sigmoid'):
+    """Return a digest of the training data and settings a checkpoint may be resumed with."""
+    fingerprint = hashlib.sha256()
+    for array in (X.indptr, X.indices, X.values if X.values is not None else np.zeros(0), np.asarray(y)):
+        fingerprint.update(np.ascontiguousarray(array))
+    settings = [X.shape, hidden_neurons, alpha, bool(dropout), dropout_percent]
+    # left out for sigmoid so earlier checkpoints can still be resumed
+    if output != 'sigmoid':
+        settings.append(output)
+    fingerprint.update(json.dumps(settings).encode('utf-8'))
+    return fingerprint.hexdigest()
+
+def save_checkpoint(path, fingerprint, epoch, stopped, last_mean_error, arrays):
+    """Atomically write the state of train_synapses after epoch - 1 to path."""
+    rng_name, rng_keys, rng_pos, rng_has_gauss, rng_cached_gaussian = np.random.get_state()
+    with atomic_write(path, 'wb') as outfile:
+        np.savez(outfile, fingerprint=np.array(fingerprint), epoch=np.array(epoch), stopped=np.array(stopped),
+                 last_mean_error=np.array(last_mean_error, dtype=np.float64),
+                 rng_keys=rng_keys, rng_pos=np.array(rng_pos), rng_has_gauss=np.array(rng_has_gauss),
+                 rng_cached_gaussian=np.array(rng_cached_gaussian), **arrays)
+
+def load_checkpoint(path, fingerprint):
+    """Return the checkpoint saved at path and restore np.random from it, or None if there is none.
+
+    Raises ValueError if it was written for other training data or settings.
+    """
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        checkpoint = {name: data[name] for name in data.files}
+    if str(checkpoint['fingerprint']) != fingerprint:
+        raise ValueError("The checkpoint {0} was written for other training data or settings".format(path))
+    np.random.set_state(('MT19937', checkpoint['rng_keys'], int(checkpoint['rng_pos']),
+                         int(checkpoint['rng_has_gauss']), float(checkpoint['rng_cached_gaussian'])))
+    return checkpoint
+
+def train_synapses(X, y, hidden_neurons=10, alpha=1, epochs=50000, dropout=False, dropout_percent=0.5, verbose=True,
+                   checkpoint=None, checkpoint_every=CHECKPOINT_EVERY, resume=False, output='sigmoid'):
+    """Full-batch gradient descent, returning the trained (synapse_0, synapse_1).
+
+    X is a dense matrix or SparseBags; either way the first layer only
+    reads and updates the rows of synapse_0 of active columns. output is
+    the output layer, see OUTPUT_LAYERS.
+
+    With a checkpoint path the state is saved there every checkpoint_every
+    epochs and when training ends. With resume, training continues from
+    that checkpoint if there is one; epochs may be raised to train longer.
+    """
+    if not isinstance(X, SparseBags):
+        X = SparseBags.from_dense(X)
+    activation = output_layer(output)
+    if verbose:
+        print ("Training with %s neurons, alpha:%s, dropout:%s %s" % (hidden_neurons, str(alpha), dropout, dropout_percent if dropout else ''))
+        print ("Input matrix: %sx%s    Output matrix: %sx%s" % (X.shape[0],X.shape[1],1, len(y[0])))
     
     np.random.seed(1)
 
     last_mean_error = 1
     # randomly initialize our weights with mean 0
-    synapse_0 = 2*np.random.random((len(X[0]), hidden_neurons)) - 1
-    synapse_1 = 2*np.random.random((hidden_neurons, len(classes))) - 1
+    synapse_0 = 2*np.random.random((X.shape[1], hidden_neurons)) - 1
+    synapse_1 = 2*np.random.random((hidden_neurons, len(y[0]))) - 1
 
-    prev_synapse_0_weight_update = np.zeros_like(synapse_0)
+    # only the rows of active columns ever get a nonzero update
+    active_columns = X.active_columns()
+    prev_synapse_0_weight_update = np.zeros((len(active_columns), hidden_neurons))
     prev_synapse_1_weight_update = np.zeros_like(synapse_1)
 
     synapse_0_direction_count = np.zeros_like(synapse_0)
     synapse_1_direction_count = np.zeros_like(synapse_1)
-        
-    for j in iter(range(epochs+1)):
+
+    first_epoch = 0
+    stopped = False
+    if checkpoint:
+        fingerprint = checkpoint_fingerprint(X, y, hidden_neurons, alpha, dropout, dropout_percent, output)
+        state = load_checkpoint(checkpoint, fingerprint) if resume else None
+        if state is not None:
+            synapse_0, synapse_1 = state['synapse_0'], state['synapse_1']
+            prev_synapse_0_weight_update = state['prev_synapse_0_weight_update']
+            prev_synapse_1_weight_update = state['prev_synapse_1_weight_update']
+            synapse_0_direction_count = state['synapse_0_direction_count']
+            synapse_1_direction_count = state['synapse_1_direction_count']
+            last_mean_error = float(state['last_mean_error'])
+            first_epoch = int(state['epoch'])
+            stopped = bool(state['stopped'])
+            if verbose:
+                print ("resuming from", checkpoint, "at epoch", first_epoch)
+
+    def save(epoch):
+        save_checkpoint(checkpoint, fingerprint, epoch, stopped, last_mean_error, {
+            'synapse_0': synapse_0, 'synapse_1': synapse_1,
+            'prev_synapse_0_weight_update': prev_synapse_0_weight_update,
+            'prev_synapse_1_weight_update': prev_synapse_1_weight_update,
+            'synapse_0_direction_count': synapse_0_direction_count,
+            'synapse_1_direction_count': synapse_1_direction_count})
+
+    for j in iter(range(first_epoch, epochs+1) if not stopped else ()):
+        instrumented = instrumentation.enabled
+        if instrumented:
+            epoch_start = time.perf_counter()
 
         # Feed forward through layers 0, 1, and 2
         layer_0 = X
-        layer_1 = sigmoid(np.dot(layer_0, synapse_0))
+        layer_1 = sigmoid(layer_0.dot(synapse_0))
                 
         if(dropout):
             layer_1 *= np.random.binomial([np.ones((len(X),hidden_neurons))],1-dropout_percent)[0] * (1.0/(1-dropout_percent))
 
-        layer_2 = sigmoid(np.dot(layer_1, synapse_1))
+        layer_2 = activation(np.dot(layer_1, synapse_1))
 
         # how much did we miss the target value?
         layer_2_error = y - layer_2
@@ -518,15 +1594,18 @@ def train(X, y, hidden_neurons=10, alpha=1, epochs=50000, dropout=False, dropout
         if (j% 10000) == 0 and j > 5000:
             # if this 10k iteration's error is greater than the last iteration, break out
             if np.mean(np.abs(layer_2_error)) < last_mean_error:
-                print ("delta after "+str(j)+" iterations:" + str(np.mean(np.abs(layer_2_error))) )
+                if verbose:
+                    print ("delta after "+str(j)+" iterations:" + str(np.mean(np.abs(layer_2_error))) )
                 last_mean_error = np.mean(np.abs(layer_2_error))
             else:
-                print ("break:", np.mean(np.abs(layer_2_error)), ">", last_mean_error )
+                if verbose:
+                    print ("break:", np.mean(np.abs(layer_2_error)), ">", last_mean_error )
+                stopped = True
                 break
                 
         # in what direction is the target value?
         # were we really sure? if so, don't change too much.
-        layer_2_delta = layer_2_error * sigmoid_output_to_derivative(layer_2)
+        layer_2_delta = output_delta(layer_2_error, layer_2, output)
 
         # how much did each l1 value contribute to the l2 error (according to the weights)?
         layer_1_error = layer_2_delta.dot(synapse_1.T)
@@ -536,79 +1615,1848 @@ def train(X, y, hidden_neurons=10, alpha=1, epochs=50000, dropout=False, dropout
         layer_1_delta = layer_1_error * sigmoid_output_to_derivative(layer_1)
         
         synapse_1_weight_update = (layer_1.T.dot(layer_2_delta))
-        synapse_0_weight_update = (layer_0.T.dot(layer_1_delta))
+        synapse_0_weight_update = layer_0.transpose_dot(layer_1_delta)[1]
         
         if(j > 0):
-            synapse_0_direction_count += np.abs(((synapse_0_weight_update > 0)+0) - ((prev_synapse_0_weight_update > 0) + 0))
+            synapse_0_direction_count[active_columns] += np.abs(((synapse_0_weight_update > 0)+0) - ((prev_synapse_0_weight_update > 0) + 0))
             synapse_1_direction_count += np.abs(((synapse_1_weight_update > 0)+0) - ((prev_synapse_1_weight_update > 0) + 0))        
         
         synapse_1 += alpha * synapse_1_weight_update
-        synapse_0 += alpha * synapse_0_weight_update
+        synapse_0[active_columns] += alpha * synapse_0_weight_update
         
         prev_synapse_0_weight_update = synapse_0_weight_update
         prev_synapse_1_weight_update = synapse_1_weight_update
 
-    now = datetime.datetime.now()
+        if instrumented:
+            instrumentation.lap('train.epoch_seconds', epoch_start)
+            instrumentation.gauge('train.epoch', j)
+            instrumentation.gauge('train.error', float(np.mean(np.abs(layer_2_error))))
+            instrumentation.gauge('train.synapse_0_direction_changes', float(synapse_0_direction_count.sum()))
+            instrumentation.gauge('train.synapse_1_direction_changes', float(synapse_1_direction_count.sum()))
+
+        if checkpoint and (j + 1) % checkpoint_every == 0:
+            save(j + 1)
+
+    if checkpoint:
+        save(max(first_epoch, epochs + 1))
+    return synapse_0, synapse_1
+
+######################################################
+# Mini-batch training
+
+# rows per mini-batch
+MINIBATCH_SIZE = 32
+
+def holdout_split(X, y, holdout=0.1, seed=1):
+    """Split X, y into (X_train, y_train, X_val, y_val) holding out a shuffled fraction."""
+    order = np.random.RandomState(seed).permutation(len(X))
+    n_val = int(round(len(X) * holdout))
+    val, tr = order[:n_val], order[n_val:]
+    return X[tr], y[tr], X[val], y[val]
+
+def minibatches(X, y, batch_size=MINIBATCH_SIZE, random_state=None):
+    """Yield (X, y) slices of batch_size rows, shuffled when a random_state is given."""
+    order = np.arange(len(X))
+    if random_state is not None:
+        random_state.shuffle(order)
+    for start in range(0, len(X), batch_size):
+        rows = order[start:start + batch_size]
+        yield X[rows], y[rows]
+
+def train_minibatch(batches, hidden_neurons=10, alpha=0.1, epochs=1000, dropout=False, dropout_percent=0.5,
+                    validation=None, eval_every=100, patience=5, dtype=np.float32, seed=1,
+                    words=(), classes=(), model_dir=MODEL_DIR, vectorizer=None, output='sigmoid'):
+    """Mini-batch gradient descent in float32 with early stopping.
+
+    batches is either a callable returning a fresh iterable of (X, y)
+    batches for every epoch, or a single iterable of batches which is
+    consumed in one pass. Only one batch is held in memory at a time.
+    X may be dense or SparseBags, y one-hot rows or class numbers, which
+    are one-hot encoded against classes a batch at a time.
+
+    Every eval_every updates the mean absolute error on the validation
+    (X, y) pair is measured; training stops after patience evaluations
+    without improvement and the best weights are kept.
+    """
+    print ("Mini-batch training with %s neurons, alpha:%s, dropout:%s %s" % (hidden_neurons, str(alpha), dropout, dropout_percent if dropout else ''))
+
+    random_state = np.random.RandomState(seed)
+    activation = output_layer(output)
+    synapse_0 = synapse_1 = None
+
+    def targets(y):
+        return one_hot(y, len(classes), dtype) if np.ndim(y) == 1 else np.asarray(y, dtype=dtype)
+
+    if validation is not None:
+        X_val, y_val = validation
+        X_val = X_val if isinstance(X_val, SparseBags) else SparseBags.from_dense(X_val)
+        y_val = targets(y_val)
+
+    def evaluate():
+        layer_1 = sigmoid(X_val.dot(synapse_0))
+        layer_2 = activation(np.dot(layer_1, synapse_1))
+        return np.mean(np.abs(y_val - layer_2))
+
+    best_error = float('inf')
+    best_synapses = None
+    bad_evaluations = 0
+    step = 0
+    stop = False
+    for epoch in range(epochs):
+        seen_batch = False
+        for X_batch, y_batch in (batches() if callable(batches) else batches):
+            seen_batch = True
+            layer_0 = X_batch if isinstance(X_batch, SparseBags) else SparseBags.from_dense(X_batch)
+            y_batch = targets(y_batch)
+
+            if synapse_0 is None:
+                # randomly initialize our weights with mean 0
+                print ("Input width: %s    Output width: %s" % (layer_0.shape[1], y_batch.shape[1]))
+                synapse_0 = (2*random_state.random_sample((layer_0.shape[1], hidden_neurons)) - 1).astype(dtype)
+                synapse_1 = (2*random_state.random_sample((hidden_neurons, y_batch.shape[1])) - 1).astype(dtype)
+
+            # Feed forward through layers 0, 1, and 2
+            layer_1 = sigmoid(layer_0.dot(synapse_0))
+            if(dropout):
+                layer_1 *= random_state.binomial(1, 1-dropout_percent, layer_1.shape).astype(dtype) * dtype(1.0/(1-dropout_percent))
+            layer_2 = activation(np.dot(layer_1, synapse_1))
+
+            # back propagate the error of this batch only
+            layer_2_delta = output_delta(y_batch - layer_2, layer_2, output)
+            layer_1_delta = layer_2_delta.dot(synapse_1.T) * sigmoid_output_to_derivative(layer_1)
+
+            synapse_1 += dtype(alpha) * layer_1.T.dot(layer_2_delta)
+            # scatter the gradient to the rows of the active columns only
+            columns, synapse_0_weight_update = layer_0.transpose_dot(layer_1_delta)
+            synapse_0[columns] += dtype(alpha) * synapse_0_weight_update
+            step += 1
+            if instrumentation.enabled:
+                instrumentation.gauge('train_minibatch.step', step)
+                instrumentation.observe('train_minibatch.batch_rows', len(layer_0))
+
+            if validation is not None and step % eval_every == 0:
+                error = evaluate()
+                if instrumentation.enabled:
+                    instrumentation.gauge('train_minibatch.validation_error', float(error))
+                if error < best_error:
+                    print ("delta after "+str(step)+" updates:" + str(error))
+                    best_error = error
+                    best_synapses = (synapse_0.copy(), synapse_1.copy())
+                    bad_evaluations = 0
+                else:
+                    bad_evaluations += 1
+                    if bad_evaluations >= patience:
+                        print ("break:", error, ">", best_error)
+                        stop = True
+                        break
+        if stop or not seen_batch:
+            break
+
+    if synapse_0 is None:
+        raise ValueError("No training batches were given")
+    # keep the last weights unless an earlier evaluation was better
+    if best_synapses is not None and (stop or evaluate() >= best_error):
+        synapse_0, synapse_1 = best_synapses
 
     # persist synapses
-    synapse = {'datetime': now.strftime("%Y-%m-%d %H:%M"),
-               'words': words,
-               'classes': classes,
-               'synapse0': synapse_0.tolist(), 'synapse1': synapse_1.tolist()
-               
-              }
-    synapse_file = "synapses.json"
-
-    with open(synapse_file, 'w') as outfile:
-        json.dump(synapse, outfile, indent=4, sort_keys=True)
-    print ("saved synapses to:", synapse_file)
+    save_model(model_dir, synapse_0, synapse_1, words, classes, vectorizer=vectorizer, output=output)
+    print ("saved synapses to:", model_dir)
+    return synapse_0, synapse_1
+
+######################################################
+# Hyperparameter sweep
+#
+# Every (configuration, fold) pair is trained by train_synapses in a
+# process pool. The CSR arrays of X and the labels y are copied once into
+# shared memory which the workers attach to, instead of being pickled
+# into every task; a task only copies out the rows of its folds.
+
+# values tried by sweep() when no grid is given
+SWEEP_GRID = {
+    'hidden_neurons': [10, 20, 40],
+    'alpha': [0.1, 0.5, 1],
+    'dropout': [False, True],
+    'dropout_percent': [0.2, 0.5],
+}
+
+# arrays of the running sweep in a worker process, see _sweep_init
+_sweep_arrays = {}
+
+def sweep_configurations(grid=None, samples=None, seed=1):
+    """Return the configurations of a grid, or a random sample of samples of them.
+
+    Grid values that are not lists are fixed for every configuration.
+    dropout_percent is dropped from configurations without dropout so
+    they are not trained twice.
+    """
+    grid = SWEEP_GRID if grid is None else grid
+    keys = sorted(grid)
+    values = [grid[key] if isinstance(grid[key], (list, tuple)) else [grid[key]] for key in keys]
+    configurations = []
+    for combination in itertools.product(*values):
+        configuration = dict(zip(keys, combination))
+        if not configuration.get('dropout', False):
+            configuration.pop('dropout_percent', None)
+        if configuration not in configurations:
+            configurations.append(configuration)
+    if samples is not None and samples < len(configurations):
+        configurations = random.Random(seed).sample(configurations, samples)
+    return configurations
+
+def _share_array(array):
+    """Copy an array into a new shared memory block, returning the block and its description."""
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return block, (block.name, array.shape, array.dtype.str)
+
+def _sweep_init(descriptions, width, outputs, folds):
+    for key, (name, shape, dtype) in descriptions.items():
+        block = shared_memory.SharedMemory(name=name)
+        _sweep_arrays[key + '_block'] = block
+        _sweep_arrays[key] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    _sweep_arrays['X'] = SparseBags(_sweep_arrays['indptr'], _sweep_arrays['indices'],
+                                    _sweep_arrays.get('values'), width)
+    # classes one-hot encoded from the class numbers in y, None when y already is
+    _sweep_arrays['outputs'] = outputs
+    _sweep_arrays['folds'] = folds
+
+def _sweep_task(task):
+    configuration_index, fold, configuration = task
+    X, y, folds = _sweep_arrays['X'], _sweep_arrays['y'], _sweep_arrays['folds']
+    outputs = _sweep_arrays['outputs']
+    test_rows = folds[fold]
+    train_rows = np.concatenate([rows for i, rows in enumerate(folds) if i != fold])
+    y_train = one_hot(y[train_rows], outputs) if outputs is not None else y[train_rows]
+
+    start_time = time.time()
+    synapse_0, synapse_1 = train_synapses(X[train_rows], y_train, verbose=False, **configuration)
+    elapsed_time = time.time() - start_time
+
+    layer_1 = sigmoid(X[test_rows].dot(synapse_0))
+    layer_2 = output_layer(configuration.get('output', 'sigmoid'))(np.dot(layer_1, synapse_1))
+    expected = y[test_rows] if outputs is not None else np.argmax(y[test_rows], axis=1)
+    accuracy = np.mean(np.argmax(layer_2, axis=1) == expected)
+    return configuration_index, fold, float(accuracy), elapsed_time
+
+def sweep(X, y, grid=None, samples=None, folds=5, processes=None, seed=1,
+          words=(), classes=(), model_dir=MODEL_DIR, vectorizer=None):
+    """k-fold cross-validate hyperparameter configurations over a process pool.
+
+    Prints and returns one report per configuration, best first, with the
+    mean accuracy over the folds and the training time summed over them.
+    Only the best configuration is retrained on all of X, y and saved.
+    X may be dense or SparseBags. y may be class numbers, one-hot encoded
+    against classes. The grid may include an output layer.
+    """
+    if not isinstance(X, SparseBags):
+        X = SparseBags.from_dense(X)
+    y = np.ascontiguousarray(y)
+    if folds < 2 or folds > len(X):
+        raise ValueError("Cannot cross-validate {0} examples in {1} folds".format(len(X), folds))
+    configurations = sweep_configurations(grid, samples, seed)
+    fold_rows = np.array_split(np.random.RandomState(seed).permutation(len(X)), folds)
+    tasks = [(i, fold, configuration)
+             for i, configuration in enumerate(configurations) for fold in range(folds)]
+    print ("Sweeping %s configurations x %s folds" % (len(configurations), folds))
+
+    reports = [{'configuration': configuration, 'accuracies': [], 'seconds': 0.0}
+               for configuration in configurations]
+    start_time = time.time()
+    arrays = {'indptr': X.indptr, 'indices': X.indices, 'y': y}
+    if X.values is not None:
+        arrays['values'] = np.ascontiguousarray(X.values)
+    blocks = []
+    descriptions = {}
+    try:
+        for key, array in arrays.items():
+            block, descriptions[key] = _share_array(array)
+            blocks.append(block)
+        outputs = len(classes) if y.ndim == 1 else None
+        pool = multiprocessing.Pool(processes, initializer=_sweep_init,
+                                    initargs=(descriptions, X.width, outputs, fold_rows))
+        try:
+            for i, fold, accuracy, elapsed_time in pool.imap_unordered(_sweep_task, tasks):
+                reports[i]['accuracies'].append(accuracy)
+                reports[i]['seconds'] += elapsed_time
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    for report in reports:
+        report['accuracy'] = float(np.mean(report['accuracies']))
+    reports.sort(key=lambda report: report['accuracy'], reverse=True)
+    for report in reports:
+        print ("accuracy: %.4f    time: %.2fs    %s" % (report['accuracy'], report['seconds'], report['configuration']))
+    print ("sweep time:", time.time() - start_time, "seconds")
+
+    best = reports[0]['configuration']
+    print ("best configuration:", best)
+    train(X, y, words=words, classes=classes, model_dir=model_dir, vectorizer=vectorizer, **best)
+    return reports
+
+######################################################
+# Streaming training data
+#
+# The functions below only ever hold one training record, the vocabulary
+# and one batch, so corpora larger than memory can be trained on with
+# train_minibatch.
+
+# tokens left out of the vocabulary
+IGNORE_WORDS = ['?']
+
+def scan_training_data(records):
+    """One streaming pass over training records, returning (words, classes, count)."""
+    words = set()
+    classes = set()
+    count = 0
+    for record in records:
+        words.update(stemmer.stem(w.lower()) for w in tokenize('string', record['sentence']) if w not in IGNORE_WORDS)
+        classes.add(record['class'])
+        count += 1
+    # sorted so the synapse layout is the same on every run
+    return sorted(words), sorted(classes), count
+
+def stream_training_batches(records, vocabulary, classes, batch_size=MINIBATCH_SIZE, dtype=np.float32):
+    """Yield (X, y) batches of batch_size records vectorized against vocabulary and classes.
+
+    X is SparseBags, y a dense one-hot matrix of dtype.
+    """
+    class_index = {c: i for i, c in enumerate(classes)}
+    records = iter(records)
+    while True:
+        chunk = list(itertools.islice(records, batch_size))
+        if not chunk:
+            return
+        X = SparseBags.from_indices([vocabulary.indices(clean_up_sentence(record['sentence'])) for record in chunk],
+                                    len(vocabulary), vocabulary)
+        yield X, one_hot([class_index[record['class']] for record in chunk], len(classes), dtype)
+
+######################################################
+# Dataset cache
+#
+# The vectorized training set (X as CSR arrays, y as class numbers, words
+# and classes) is kept in one .npz file per corpus. Its name is a digest of
+# everything the vectors depend on, so a changed corpus, stemmer, tokenizer
+# or vectorizer simply misses the cache and is vectorized again.
+
+# default directory of the dataset cache
+DATASET_CACHE_DIR = 'dataset_cache'
+DATASET_FORMAT = 1
+# datasets kept in a cache directory, the most recently used ones survive
+DATASET_CACHE_SIZE = 4
+
+def tokenizer_fingerprint():
+    """Return the settings which decide the tokens of a sentence."""
+    return [TOKEN_PATTERN.pattern, TOKEN_PATTERN.flags, IGNORE_WORDS]
+
+def dataset_key(training_file, stemmer=stemmer, vectorizer=None, dictionary_file=None):
+    """Return the cache key of the dataset vectorized from training_file.
+
+    dictionary_file is given when templates are expanded from it.
+    """
+    key = hashlib.sha256()
+    key.update(json.dumps([DATASET_FORMAT, stemmer.fingerprint(), tokenizer_fingerprint(),
+                           vectorizer.config() if vectorizer is not None else None]).encode('utf-8'))
+    for path in (training_file, dictionary_file):
+        if path is None:
+            continue
+        with open(path, 'rb') as data_file:
+            for chunk in iter(lambda: data_file.read(1 << 20), b''):
+                key.update(chunk)
+    return key.hexdigest()
+
+def dataset_path(cache_dir, key):
+    return os.path.join(cache_dir, 'dataset-%s.npz' % key[:32])
+
+def save_dataset(cache_dir, key, X, y, words, classes):
+    """Atomically write a vectorized dataset to the cache, see load_dataset().
+
+    y is the vector of class numbers, or their one-hot rows.
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    arrays = {'key': np.array(key), 'indptr': X.indptr, 'indices': X.indices,
+              'width': np.array(X.width), 'labels': np.asarray(y if np.ndim(y) == 1 else np.argmax(y, axis=1), dtype=np.int32),
+              'words': np.array(words, dtype=str), 'classes': np.array(classes, dtype=str)}
+    if X.values is not None:
+        arrays['values'] = X.values
+    path = dataset_path(cache_dir, key)
+    with atomic_write(path, 'wb') as outfile:
+        np.savez(outfile, **arrays)
+
+    trim_cache(cache_dir)
+    return path
+
+def trim_cache(cache_dir):
+    """Remove all but the DATASET_CACHE_SIZE most recently used keys from the cache.
+
+    The dataset and the example index of a key are removed together.
+    """
+    cached = {}
+    for f in os.listdir(cache_dir):
+        kind, _, name = f.partition('-')
+        if kind in ('dataset', 'examples') and f.endswith('.npz'):
+            cached.setdefault(name, []).append(os.path.join(cache_dir, f))
+    used = sorted(cached, key=lambda name: max(os.path.getmtime(path) for path in cached[name]))
+    for name in used[:-DATASET_CACHE_SIZE]:
+        for path in cached[name]:
+            os.remove(path)
+
+def load_dataset(cache_dir, key):
+    """Return the cached (X, y, words, classes) of key, y as class numbers, or None on a miss."""
+    path = dataset_path(cache_dir, key)
+    try:
+        data = np.load(path)
+    except (IOError, ValueError):
+        return None
+    with data:
+        if str(data['key']) != key:
+            return None
+        X = SparseBags(data['indptr'], data['indices'], data['values'] if 'values' in data else None,
+                       int(data['width']))
+        classes = data['classes'].tolist()
+        y = data['labels']
+        words = data['words'].tolist()
+    # mark it as recently used
+    os.utime(path)
+    return X, y, words, classes
+
+######################################################
+# Incremental learning
+
+def update_synapses(synapse_0, synapse_1, words, classes, examples, steps=200, alpha=10,
+                    anchors=256, anchor_words=3, seed=1, vectorizer=None, output='sigmoid'):
+    """Grow a trained network to new labeled examples and fine-tune it on them.
+
+    examples is a list of (sentence, class) pairs. Unseen stems are appended
+    to words with zero weights in synapse_0, unseen classes are appended to
+    classes with randomly initialized columns in synapse_1. All learned
+    weights are kept and the network is trained for steps full-batch
+    updates, so the cost scales with the update and not with the corpus.
+
+    So that new classes do not fire on everything, the examples are mixed
+    with anchors pseudo-rehearsal rows: bags of anchor_words random known
+    words whose targets are the outputs of the network before the update.
+    With a HashingVocabulary as vectorizer the input layer is fixed and
+    only classes grow. output is the output layer of the network.
+    Returns the new (synapse_0, synapse_1, words, classes).
+    """
+    random_state = np.random.RandomState(seed)
+    activation = output_layer(output)
+    n_words, n_classes = synapse_0.shape[0], len(classes)
+    anchor_columns = [np.unique(random_state.randint(n_words, size=anchor_words))
+                      for _ in range(anchors if n_words else 0)]
+    anchor_rows = SparseBags.from_indices(anchor_columns, n_words)
+    anchor_targets = activation(np.dot(sigmoid(anchor_rows.dot(synapse_0)), synapse_1))
+
+    vocabulary = Vocabulary(words) if vectorizer is None else vectorizer
+    classes = list(classes)
+    for sentence, label in examples:
+        for w in tokenize('string', sentence):
+            if vectorizer is None and w not in IGNORE_WORDS:
+                vocabulary.add(stemmer.stem(w.lower()))
+        if label not in classes:
+            classes.append(label)
+
+    # new words start without any influence, new classes like a fresh network
+    hidden_neurons = synapse_1.shape[0]
+    new_rows = np.zeros((len(vocabulary) - synapse_0.shape[0], hidden_neurons), dtype=synapse_0.dtype)
+    new_columns = (2*random_state.random_sample((hidden_neurons, len(classes) - synapse_1.shape[1])) - 1).astype(synapse_1.dtype)
+    synapse_0 = np.concatenate([synapse_0, new_rows])
+    synapse_1 = np.concatenate([synapse_1, new_columns], axis=1)
+
+    class_index = {c: i for i, c in enumerate(classes)}
+    y = one_hot([class_index[label] for sentence, label in examples], len(classes), synapse_1.dtype)
+
+    # the anchors keep their old outputs and stay off for the new words and classes,
+    # the examples are weighted up so both sides pull equally hard
+    # (anchor columns are plain columns, which every vocabulary decodes as themselves)
+    layer_0 = SparseBags.from_indices(
+        [vocabulary.indices(clean_up_sentence(sentence)) for sentence, label in examples] + anchor_columns,
+        len(vocabulary), vocabulary)
+    y = np.concatenate([y, np.pad(anchor_targets, ((0, 0), (0, len(classes) - n_classes))).astype(y.dtype)])
+    row_weights = np.ones((len(y), 1), dtype=y.dtype)
+    row_weights[:len(examples)] = max(1.0, len(anchor_rows) / float(len(examples)))
+    # averaged rather than summed, so alpha does not depend on the number of anchors
+    row_weights /= row_weights.sum()
+
+    for j in range(steps):
+        layer_1 = sigmoid(layer_0.dot(synapse_0))
+        layer_2 = activation(np.dot(layer_1, synapse_1))
+        layer_2_delta = row_weights * output_delta(y - layer_2, layer_2, output)
+        layer_1_delta = layer_2_delta.dot(synapse_1.T) * sigmoid_output_to_derivative(layer_1)
+        synapse_1 += alpha * layer_1.T.dot(layer_2_delta)
+        columns, synapse_0_weight_update = layer_0.transpose_dot(layer_1_delta)
+        synapse_0[columns] += alpha * synapse_0_weight_update
+
+    return synapse_0, synapse_1, vocabulary.words, classes
 
 ######################################################
-# Training
-X = np.array(training)
-y = np.array(output)
+# Quantization
+#
+# A trained model can be exported with its synapses stored as float16, or
+# as int8 with one float32 scale per column kept in the manifest. Such a
+# model is loaded like any other; SparseBags.dot() sums the weight rows of
+# the active columns in float32, so the int8 input weights are never
+# widened as a whole. Only the small hidden layer synapse is, once at load.
+
+QUANTIZE_DTYPES = ('float16', 'int8')
+
+def quantize_synapse(synapse, dtype):
+    """Return the (weights, scales) of a synapse quantized to dtype, scales is None for float16."""
+    if dtype == 'float16':
+        return synapse.astype(np.float16), None
+    if dtype != 'int8':
+        raise ValueError("Cannot quantize to {0}, expected one of {1}".format(dtype, QUANTIZE_DTYPES))
+    # symmetric per column, the largest weight of a column maps to 127
+    scales = np.abs(synapse).max(axis=0) / 127.0
+    scales[scales == 0] = 1.0
+    weights = np.clip(np.round(synapse / scales), -127, 127).astype(np.int8)
+    return weights, scales.astype(np.float32)
 
-start_time = time.time()
+def quantize_model(model_dir, output_dir, dtype='int8'):
+    """Write a quantized copy of the model in model_dir to output_dir and return its manifest."""
+    model = load_model(model_dir, mmap=False)
+    if model.get('quantization'):
+        raise ValueError("The model in {0} is already quantized".format(model_dir))
+    synapse_0, scales_0 = quantize_synapse(model['synapse0'], dtype)
+    synapse_1, scales_1 = quantize_synapse(model['synapse1'], dtype)
+    quantization = {'dtype': dtype, 'source': model['checksum']}
+    if scales_0 is not None:
+        quantization['scales'] = {'synapse0': scales_0.tolist(), 'synapse1': scales_1.tolist()}
+    vectorizer = model_vocabulary(model) if model.get('vectorizer') else None
+    now = datetime.datetime.strptime(model['datetime'], "%Y-%m-%d %H:%M")
+    return save_model(output_dir, synapse_0, synapse_1, model['words'], model['classes'],
+                      now, vectorizer, quantization, model.get('output', 'sigmoid'))
 
-#train(X, y, hidden_neurons=20, alpha=0.1, epochs=100000, dropout=False, dropout_percent=0.2)
+def model_nbytes(model):
+    """Return the bytes taken by the synapses of a model."""
+    return int(model['synapse0'].nbytes + model['synapse1'].nbytes)
 
-elapsed_time = time.time() - start_time
-print("\nTraining results")
-print ("processing time:", elapsed_time, "seconds")
 ######################################################
+# Nearest examples
+#
+# Sentences the network has no confident class for can still be matched
+# against the labeled training examples. ExampleIndex maps every stem to
+# the sorted ids of the examples containing it (its posting list), so a
+# query only reads the postings of its own stems instead of every
+# example. Examples are scored by the cosine of their TF-IDF vectors.
+
+# file of the example index kept in model_dir, a copy of the one in the
+# dataset cache when there is one
+EXAMPLE_INDEX_FILE = 'examples.npz'
+EXAMPLE_INDEX_FORMAT = 2
+# examples returned by nearest_examples()
+NEAREST_K = 3
+
+class ExampleIndex(object):
+    """An inverted index from stem to the training examples containing it.
+
+    The postings of all stems are kept in one array, those of stems[i]
+    being postings[indptr[i]:indptr[i + 1]]. Likewise the sentences are
+    kept as one UTF-8 text, that of example i being
+    text[offsets[i]:offsets[i + 1]]. key is the dataset key of the corpus
+    the index was built from, see dataset_key().
+    """
+
+    def __init__(self, stems, indptr, postings, labels, classes, offsets, text, key=None):
+        self.stems = stems
+        self.indptr = indptr
+        self.postings = postings
+        self.labels = labels
+        self.classes = classes
+        self.offsets = offsets
+        self.text = text
+        self.key = key
+        # smoothed idf of every stem and the norm of every example's TF-IDF vector
+        df = np.diff(indptr)
+        self.idf = np.log((1.0 + len(labels)) / (1.0 + df)) + 1.0
+        self.norms = np.sqrt(np.bincount(postings, np.repeat(self.idf ** 2, df), minlength=len(labels)))
+        self._rows = None
+
+    @classmethod
+    def build(cls, examples, key=None):
+        """Index (tokens, class) pairs, the documents of a corpus."""
+        postings = {}
+        labels = []
+        classes = {}
+        sentences = []
+        for example, (tokens, label) in enumerate(examples):
+            for stem in set(stemmer.stem(word.lower()) for word in tokens if word not in IGNORE_WORDS):
+                postings.setdefault(stem, []).append(example)
+            labels.append(classes.setdefault(label, len(classes)))
+            sentences.append(' '.join(tokens).encode('utf-8'))
+        stems = sorted(postings)
+        indptr = np.zeros(len(stems) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(postings[stem]) for stem in stems])
+        flat = np.fromiter(itertools.chain.from_iterable(postings[stem] for stem in stems),
+                           dtype=np.int32, count=int(indptr[-1]))
+        offsets = np.zeros(len(sentences) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(sentence) for sentence in sentences])
+        text = np.frombuffer(b''.join(sentences), dtype=np.uint8)
+        return cls(stems, indptr, flat, np.array(labels, dtype=np.int32),
+                   sorted(classes, key=classes.get), offsets, text, key)
+
+    def save(self, path):
+        """Atomically write the index to an .npz file, see load()."""
+        with atomic_write(path, 'wb') as outfile:
+            np.savez(outfile, format=np.array(EXAMPLE_INDEX_FORMAT), key=np.array(self.key or ''),
+                     stems=np.array(self.stems, dtype=str), indptr=self.indptr, postings=self.postings,
+                     labels=self.labels, classes=np.array(self.classes, dtype=str),
+                     offsets=self.offsets, text=self.text)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if int(data['format']) != EXAMPLE_INDEX_FORMAT:
+                raise ValueError("Unsupported example index format {0} in {1}".format(int(data['format']), path))
+            return cls(data['stems'].tolist(), data['indptr'], data['postings'], data['labels'],
+                       data['classes'].tolist(), data['offsets'], data['text'], str(data['key']) or None)
 
+    def __len__(self):
+        return len(self.labels)
+
+    def sentence(self, example):
+        return self.text[self.offsets[example]:self.offsets[example + 1]].tobytes().decode('utf-8')
+
+    def rows(self, stems):
+        """Return the rows of the indexed stems among stems, each once."""
+        if self._rows is None:
+            self._rows = {stem: row for row, stem in enumerate(self.stems)}
+        rows = self._rows
+        return sorted(set(rows[stem] for stem in stems if stem in rows))
+
+    def search(self, stems, k=NEAREST_K):
+        """Return the k examples most similar to stems, best first.
+
+        Each is a dict of the example id, its class, its sentence and the
+        cosine similarity of the two, examples sharing no stem are left out.
+        """
+        rows = self.rows(stems)
+        if not rows or not k:
+            return []
+        starts, ends = self.indptr[rows], self.indptr[np.add(rows, 1)]
+        examples = np.concatenate([self.postings[start:end] for start, end in zip(starts, ends)])
+        weights = np.repeat(self.idf[rows] ** 2, ends - starts)
+        # sum the shared stems' weights of every example reached
+        examples, inverse = np.unique(examples, return_inverse=True)
+        scores = np.bincount(inverse, weights) / (self.norms[examples] * np.sqrt(np.sum(self.idf[rows] ** 2)))
+        if k < len(examples):
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(examples))
+        top = top[np.lexsort((examples[top], -scores[top]))]
+        return [{'example': int(examples[i]), 'class': self.classes[self.labels[examples[i]]],
+                 'sentence': self.sentence(examples[i]), 'score': float(scores[i])} for i in top]
+
+    def __repr__(self):
+        return '<ExampleIndex %s examples, %s stems>' % (len(self), len(self.stems))
+
+def example_index_path(cache_dir, key):
+    return os.path.join(cache_dir, 'examples-%s.npz' % key[:32])
+
+def load_example_index(cache_dir, key):
+    """Return the cached ExampleIndex of key, or None on a miss."""
+    path = example_index_path(cache_dir, key)
+    try:
+        index = ExampleIndex.load(path)
+    except (IOError, ValueError, KeyError):
+        return None
+    if index.key != key:
+        return None
+    # mark it as recently used
+    os.utime(path)
+    return index
 
 ######################################################
 # Probability and Guessing
 
+# default training corpus
+TRAINING_FILE = 'training_data.json'
+
 # probability threshold
 ERROR_THRESHOLD = 0.2
 
-# load our calculated synapse values
-synapse_file = 'synapses.json' 
-with open(synapse_file) as data_file: 
-    synapse = json.load(data_file) 
-    synapse_0 = np.asarray(synapse['synapse0']) 
-    synapse_1 = np.asarray(synapse['synapse1'])
+# number of sentences pushed through the network at once by classify_batch
+BATCH_CHUNK_SIZE = 1024
+
+# results remembered by the classification cache of a Brain
+RESULT_CACHE_SIZE = 10000
+
+# seconds Brain.load() may take to cold start on a saved model, see test_core.py
+COLD_START_TARGET = 0.5
+
+# classes up to which a single row is ranked in Python by top_classes
+TOP_CLASSES_SCAN = 64
+
+def top_classes(results, threshold, top_k=None):
+    """Return the [class number, score] pairs above threshold of every row of results, best first.
+
+    With top_k only the classes scoring at least the k-th best score of
+    their row, found by np.partition, are sorted, so a row costs one pass
+    over the classes plus a sort of k of them. Ties keep the class order
+    like sort().
+    """
+    rows_count, width = results.shape
+    if top_k is not None and top_k <= 0:
+        return [[] for _ in range(rows_count)]
+    if rows_count == 1 and width <= TOP_CLASSES_SCAN:
+        # a plain loop beats the numpy calls below on a short row
+        pairs = [[c, score] for c, score in enumerate(results[0].tolist()) if score > threshold]
+        pairs.sort(key=lambda pair: pair[1], reverse=True)
+        return [pairs[:top_k]]
+    candidates = results > threshold
+    if top_k is not None and top_k < width:
+        # ties with the k-th best score are cut after sorting
+        candidates &= results >= -np.partition(-results, top_k - 1, axis=1)[:, top_k - 1:top_k]
+    if rows_count == 1:
+        # one sentence, skip the bookkeeping of splitting rows
+        row = results[0]
+        columns = np.flatnonzero(candidates[0])
+        columns = columns[np.argsort(-row[columns], kind='stable')][:top_k]
+        return [[[c, score] for c, score in zip(columns.tolist(), row[columns].tolist())]]
+
+    rows, columns = np.nonzero(candidates)
+    scores = results[rows, columns]
+    order = np.lexsort((columns, -scores, rows))
+    rows, columns, scores = rows[order], columns[order], scores[order]
+    if top_k is not None:
+        # rank within the row
+        keep = np.arange(len(rows)) - np.searchsorted(rows, rows) < top_k
+        rows, columns, scores = rows[keep], columns[keep], scores[keep]
+    columns, scores = columns.tolist(), scores.tolist()
+    pairs = []
+    start = 0
+    for end in np.cumsum(np.bincount(rows, minlength=rows_count)).tolist():
+        pairs.append([[c, score] for c, score in zip(columns[start:end], scores[start:end])])
+        start = end
+    return pairs
+
+class ResultCache(object):
+    """LRU cache of classification results with an optional time to live.
+
+    Keys are the canonical active-feature set of a bag of words, so every
+    sentence that stems to the same bag shares one entry. Entries belong
+    to one model version: a lookup for another version empties the cache.
+    """
+
+    def __init__(self, maxsize=RESULT_CACHE_SIZE, ttl=None):
+        self.maxsize = maxsize
+        # seconds an entry stays valid, None for no limit
+        self.ttl = ttl
+        self.version = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def __check_version(self, version):
+        if version != self.version:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self.version = version
+
+    def get(self, key, version):
+        """Return the cached value of key for this model version, or None."""
+        if not self.maxsize:
+            return None
+        with self._lock:
+            self.__check_version(version)
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[1] > self.ttl:
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, version):
+        if not self.maxsize:
+            return
+        with self._lock:
+            self.__check_version(version)
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def info(self):
+        """Return the counters and occupancy of the cache."""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'invalidations': self.invalidations,
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+        }
+
+    def __repr__(self):
+        return '<ResultCache %s/%s>' % (len(self._entries), self.maxsize)
+
+# sentences per task of Classifier.classify_parallel
+PARALLEL_CHUNK_SIZE = 256
+
+# thread pools of classify_parallel by size, kept so their threads keep their scratch state
+_parallel_pools = {}
+_parallel_pools_lock = threading.Lock()
+
+def _parallel_pool(threads):
+    with _parallel_pools_lock:
+        pool = _parallel_pools.get(threads)
+        if pool is None:
+            pool = _parallel_pools[threads] = concurrent.futures.ThreadPoolExecutor(threads, 'lios-classify')
+        return pool
+
+class Classifier(object):
+    """An immutable snapshot of a loaded model, safe to share between threads.
+
+    Everything it reads is fixed when it is built: the weights are read-only
+    views and the classes a tuple. The only state it writes is the output
+    buffer of the forward pass, one per thread, and the stems go through
+    the thread-safe cache of the module stemmer, so no lock is taken. The
+    gathers and np.dot release the GIL, which classify_parallel puts to use
+    by spreading a workload over threads.
+    """
+
+    def __init__(self, model, error_threshold=ERROR_THRESHOLD):
+        synapse_0, synapse_1 = model['synapse0'].view(), model.get('synapse1_float32', model['synapse1']).view()
+        synapse_0.flags.writeable = synapse_1.flags.writeable = False
+        fields = {
+            'version': model.get('version'),
+            'checksum': model['checksum'],
+            'vocabulary': model['vocabulary'],
+            'classes': tuple(model['classes']),
+            'synapse_0': synapse_0,
+            'synapse_1': synapse_1,
+            'quantized': 'quantization' in model,
+            'output': model.get('output', 'sigmoid'),
+            'scales': model.get('scales'),
+            'error_threshold': error_threshold,
+            # per thread forward pass buffer
+            '_local': threading.local(),
+        }
+        for name, value in fields.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Classifier is immutable")
+
+    def _buffer(self, rows, dtype):
+        local = self._local
+        buffer = getattr(local, 'buffer', None)
+        if buffer is None or len(buffer) < rows or buffer.dtype != dtype:
+            buffer = local.buffer = np.empty((max(rows, PARALLEL_CHUNK_SIZE), len(self.classes)), dtype=dtype)
+        return buffer[:rows]
+
+    def columns(self, sentence):
+        """Return the active columns of the bag of words of a sentence."""
+        stem = stemmer.stem
+        return self.vocabulary.indices([stem(word) for word in tokenize('string', sentence)])
+
+    def _forward(self, columns_list):
+        # the output rows live in this thread's buffer until the next call
+        l0 = SparseBags.from_indices(columns_list, len(self.vocabulary), self.vocabulary)
+        synapse_1 = self.synapse_1
+        if self.quantized:
+            l1 = l0.dot(self.synapse_0, np.float32)
+            if self.scales is not None:
+                l1 *= self.scales[0]
+        else:
+            l1 = l0.dot(self.synapse_0)
+        l1 = sigmoid(l1)
+        l2 = np.dot(l1, synapse_1, out=self._buffer(len(l1), np.result_type(l1, synapse_1)))
+        if self.output == 'softmax':
+            # softmax in place
+            l2 -= np.max(l2, axis=1, keepdims=True)
+            np.exp(l2, out=l2)
+            l2 /= np.sum(l2, axis=1, keepdims=True)
+            return l2
+        # sigmoid in place
+        np.negative(l2, out=l2)
+        np.exp(l2, out=l2)
+        l2 += 1
+        np.reciprocal(l2, out=l2)
+        return l2
+
+    def think(self, sentence):
+        return self._forward([self.columns(sentence)])[0].copy()
+
+    def classify(self, sentence, threshold=None):
+        return self.classify_batch([sentence], threshold)[0]
+
+    def classify_batch(self, sentences, threshold=None, top_k=None, chunk_size=PARALLEL_CHUNK_SIZE):
+        """Return the Brain.classify_batch() results of sentences, classified in this thread."""
+        threshold = self.error_threshold if threshold is None else threshold
+        classes = self.classes
+        sentences = iter(sentences)
+        return_results = []
+        while True:
+            chunk = list(itertools.islice(sentences, chunk_size))
+            if not chunk:
+                return return_results
+            results = self._forward([self.columns(sentence) for sentence in chunk])
+            for pairs in top_classes(results, threshold, top_k):
+                return_results.append([[classes[c], score] for c, score in pairs])
+
+    def classify_parallel(self, sentences, threads=None, threshold=None, top_k=None, chunk_size=PARALLEL_CHUNK_SIZE):
+        """Classify sentences in chunk_size chunks over a pool of threads, results in input order.
+
+        threads defaults to the number of CPUs; with one thread, or a
+        single chunk, the sentences are classified in the calling thread.
+        """
+        sentences = list(sentences)
+        chunks = [sentences[i:i + chunk_size] for i in range(0, len(sentences), chunk_size)]
+        threads = threads or os.cpu_count() or 1
+        if threads == 1 or len(chunks) <= 1:
+            return self.classify_batch(sentences, threshold, top_k, chunk_size)
+        return_results = []
+        # map yields in submission order, whichever thread finishes first
+        for chunk_results in _parallel_pool(threads).map(
+                lambda chunk: self.classify_batch(chunk, threshold, top_k, chunk_size), chunks):
+            return_results.extend(chunk_results)
+        return return_results
+
+    def __repr__(self):
+        return '<Classifier %s, %s classes>' % (self.version, len(self.classes))
+
+class Brain(object):
+    """The training corpus and trained network of liOS.
+
+    Nothing is read from disk until an entry point needs it: classifying
+    only loads the model from model_dir, while the training data is only
+    read and vectorized for training.
+    """
+
+    def __init__(self, training_file=TRAINING_FILE, model_dir=MODEL_DIR, error_threshold=ERROR_THRESHOLD,
+                 cache_size=RESULT_CACHE_SIZE, cache_ttl=None, dictionary_file=DICTIONARY_FILE,
+                 expand_templates=False, vectorizer=None, dataset_cache_dir=DATASET_CACHE_DIR):
+        self.training_file = training_file
+        self.model_dir = model_dir
+        self.error_threshold = error_threshold
+        self.dictionary_file = dictionary_file
+        # fill the slots of training sentences from the dictionary, see expand_templates()
+        self.expand_templates = expand_templates
+        # HashingVocabulary to train with, None for a vocabulary of the corpus words
+        self.vectorizer = vectorizer
+        # where the vectorized training set is cached, None to always vectorize, see dataset()
+        self.dataset_cache_dir = dataset_cache_dir
+        self._dictionary = None
+        self._entity_matcher = None
+        # classification results by bag of words, see ResultCache
+        self.result_cache = ResultCache(cache_size, cache_ttl)
+        self._corpus = None
+        # the model in use and its saved versions
+        self.registry = ModelRegistry(model_dir)
+        # the modification stamp of the example index file and the index read from it
+        self._example_index = None
+        # seconds spent by the last load()
+        self.load_time = None
+
+    ######################################################
+    # Training data
+
+    @property
+    def dictionary(self):
+        if self._dictionary is None:
+            self._dictionary = load_dictionary(self.dictionary_file)
+        return self._dictionary
+
+    def iter_training_data(self):
+        """Stream the training records, with their templates expanded if enabled."""
+        records = json_utils.iter_training_data(self.training_file)
+        if self.expand_templates:
+            records = expand_templates(records, self.dictionary)
+        return records
+
+    def load_training_data(self, verbose=False):
+        """Read and stem the training corpus into words, classes and documents."""
+        training_data = self.iter_training_data()
+
+        words = []
+        classes = []
+        documents = []
+        ignore_words = IGNORE_WORDS
+        # loop through each sentence in our training data
+        for pattern in training_data:
+            # tokenize each word in the sentence
+            w = tokenize('string', pattern['sentence'])
+            words.extend(w)
+
+            # add to documents in our corpus
+            documents.append((w, pattern['class']))
+            if pattern['class'] not in classes:
+                classes.append(pattern['class'])
+
+        # stem and lower each word and remove duplicates, sorted so the
+        # synapse layout is the same on every run
+        words = sorted(set(stemmer.stem(w.lower()) for w in words if w not in ignore_words))
+
+        # remove duplicates
+        classes = sorted(set(classes))
+
+        if verbose:
+            print("%s sentences in training data" % len(documents))
+            print("Documents:", str(len(documents)))
+            print("Classes:", str(len(classes)), classes)
+            print("USW:", str(len(words)), words)
+
+        self._corpus = {'words': words, 'classes': classes, 'documents': documents}
+        return self._corpus
+
+    @property
+    def corpus(self):
+        if self._corpus is None:
+            self.load_training_data()
+        return self._corpus
+
+    @property
+    def documents(self):
+        return self.corpus['documents']
+
+    def training_vocabulary(self, words):
+        """Return the vocabulary to train on and the words to save with the model."""
+        if self.vectorizer is not None:
+            return self.vectorizer, []
+        return Vocabulary(words), words
+
+    def training_set(self, verbose=False, sparse=False, labels=False):
+        """Return the X bag of words matrix and y one-hot matrix of the corpus.
+
+        With sparse=True X is returned as SparseBags, with labels=True y is
+        the vector of class numbers instead.
+        """
+        corpus = self.corpus
+        classes = corpus['classes']
+        documents = corpus['documents']
+        vocabulary = self.training_vocabulary(corpus['words'])[0]
+
+        # the class number of every document
+        class_index = {c: i for i, c in enumerate(classes)}
+        output = np.fromiter((class_index[doc[1]] for doc in documents), dtype=np.int32, count=len(documents))
+        if not labels:
+            # output is a '0' for each tag and '1' for current tag
+            output = one_hot(output, len(classes))
+
+        # training set, bag of words for each sentence (stem each word first)
+        columns_list = [vocabulary.indices([stemmer.stem(word.lower()) for word in doc[0]]) for doc in documents]
+        if sparse:
+            training = SparseBags.from_indices(columns_list, len(vocabulary), vocabulary)
+        else:
+            training = vocabulary.from_indices(columns_list)
+
+        if verbose:
+            # sample training/output
+            i = 0
+            w = documents[i][0]
+            print("\nSample Training/output")
+            print([stemmer.stem(word.lower()) for word in w])
+            print(vocabulary.from_indices(columns_list[i:i + 1])[0])
+            print(output[i])
+
+        return training, output
+
+    def dataset_key(self):
+        return dataset_key(self.training_file, stemmer, self.vectorizer,
+                           self.dictionary_file if self.expand_templates else None)
+
+    def dataset(self, verbose=False):
+        """Return the (X, y, words, classes) to train on, X as SparseBags and y as class numbers.
+
+        They are read from the dataset cache when the training file, the
+        stemmer, the tokenizer and the vectorizer are unchanged, otherwise
+        the corpus is vectorized and the cache rebuilt. words are those
+        saved with the model, empty for a HashingVocabulary.
+        """
+        key = None
+        if self.dataset_cache_dir:
+            key = self.dataset_key()
+            dataset = load_dataset(self.dataset_cache_dir, key)
+            if dataset is not None:
+                if verbose:
+                    print ("loaded %s sentences from dataset cache: %s" % (len(dataset[0]), self.dataset_cache_dir))
+                return dataset
+        # a miss means the training file may have changed since the corpus was read
+        if self._corpus is None or key is not None:
+            self.load_training_data(verbose)
+        X, y = self.training_set(verbose, sparse=True, labels=True)
+        words = self.training_vocabulary(self.corpus['words'])[1]
+        classes = self.corpus['classes']
+        if key is not None:
+            save_dataset(self.dataset_cache_dir, key, X, y, words, classes)
+            # index the examples while the corpus is at hand, see build_example_index
+            self._save_example_index(ExampleIndex.build(self.corpus['documents'], key))
+        return X, y, words, classes
+
+    def train(self, verbose=True, **kwargs):
+        """Train on the corpus and save the model to model_dir, see train()."""
+        X, y, words, classes = self.dataset(verbose)
+        train(X, y, words=words, classes=classes,
+              model_dir=self.model_dir, vectorizer=self.vectorizer, **kwargs)
+        # pick up the new synapses on next use
+        self.registry.reset()
+        self.build_example_index()
+
+    def train_minibatch(self, batch_size=MINIBATCH_SIZE, holdout=0.1, verbose=True, **kwargs):
+        """Mini-batch train on the corpus, early stopping on a held-out split, see train_minibatch()."""
+        X, y, words, classes = self.dataset(verbose)
+        X_train, y_train, X_val, y_val = holdout_split(X, y, holdout)
+        random_state = np.random.RandomState(1)
+        train_minibatch(lambda: minibatches(X_train, y_train, batch_size, random_state),
+                        validation=(X_val, y_val) if len(X_val) else None,
+                        words=words, classes=classes,
+                        model_dir=self.model_dir, vectorizer=self.vectorizer, **kwargs)
+        # pick up the new synapses on next use
+        self.registry.reset()
+        self.build_example_index()
+
+    def train_streaming(self, batch_size=MINIBATCH_SIZE, holdout_every=10, max_validation=1000, verbose=True, **kwargs):
+        """Mini-batch train straight from the training file without loading the corpus.
+
+        The vocabulary and classes are built in one streaming pass, then
+        every epoch streams the file again in batches. Every holdout_every-th
+        record, up to max_validation of them, is held out for early stopping;
+        every other record is trained on.
+        """
+        records = self.iter_training_data
+
+        words, classes, count = scan_training_data(records())
+        if verbose:
+            print("%s sentences in training data" % count)
+            print("Classes:", str(len(classes)), classes)
+            print("USW:", str(len(words)))
+        vocabulary, words = self.training_vocabulary(words)
+
+        def held_out(i):
+            # past the first max_validation held out records every record is trained on
+            return bool(holdout_every) and i % holdout_every == 0 and i < holdout_every * max_validation
+
+        validation = None
+        if holdout_every:
+            held = (r for i, r in enumerate(records()) if held_out(i))
+            validation = next(stream_training_batches(held, vocabulary, classes, max_validation), None)
+
+        def batches():
+            kept = (r for i, r in enumerate(records()) if not held_out(i))
+            return stream_training_batches(kept, vocabulary, classes, batch_size)
+
+        train_minibatch(batches, validation=validation, words=words, classes=classes,
+                        model_dir=self.model_dir, vectorizer=self.vectorizer, **kwargs)
+        # pick up the new synapses on next use
+        self.registry.reset()
+        self.build_example_index()
+
+    def update(self, examples, steps=200, alpha=10, verbose=True, **kwargs):
+        """Learn new labeled sentences without retraining on the corpus, see update_synapses().
+
+        examples are (sentence, class) pairs or training records. The grown
+        model is saved atomically to model_dir and used from then on.
+        """
+        examples = [(e['sentence'], e['class']) if isinstance(e, dict) else tuple(e) for e in examples]
+        model = self.model
+        if model.get('quantization'):
+            raise ValueError("The quantized model in {0} cannot be updated, update and quantize its source".format(self.model_dir))
+        # a hashed model keeps its input layer, only a words vocabulary grows
+        vectorizer = model['vocabulary'] if model.get('vectorizer') else None
+        synapse_0, synapse_1, words, classes = update_synapses(
+            np.array(model['synapse0']), np.array(model['synapse1']),
+            model['words'], model['classes'], examples, steps, alpha, vectorizer=vectorizer,
+            output=model.get('output', 'sigmoid'), **kwargs)
+        if verbose:
+            print ("Updated with %s sentences: %s new words, %s new classes" % (
+                len(examples), len(words) - len(model['words']), len(classes) - len(model['classes'])))
+        save_model(self.model_dir, synapse_0, synapse_1, words, classes, vectorizer=vectorizer,
+                   output=model.get('output', 'sigmoid'))
+        # pick up the new synapses on next use
+        self.registry.reset()
+
+    def sweep(self, grid=None, verbose=True, **kwargs):
+        """Cross-validate a hyperparameter grid on the corpus and save the best model, see sweep()."""
+        X, y, words, classes = self.dataset(verbose)
+        # the workers share the CSR arrays
+        reports = sweep(X, y, grid, words=words, classes=classes,
+                        model_dir=self.model_dir, vectorizer=self.vectorizer, **kwargs)
+        # pick up the new synapses on next use
+        self.registry.reset()
+        self.build_example_index()
+        return reports
+
+    def quantize(self, dtype='int8', output_dir=None, verbose=True):
+        """Export a quantized copy of the model and report its parity on the training data.
+
+        The copy is written to output_dir, model_dir-<dtype> by default,
+        and can be served with Brain(model_dir=output_dir). Returns the
+        report of quantization_report().
+        """
+        output_dir = output_dir or '%s-%s' % (self.model_dir.rstrip(os.sep), dtype)
+        quantize_model(self.model_dir, output_dir, dtype)
+        quantized = Brain(self.training_file, output_dir, self.error_threshold, cache_size=0,
+                          dictionary_file=self.dictionary_file, expand_templates=self.expand_templates)
+        report = self.quantization_report(quantized)
+        if verbose:
+            print ("saved %s synapses to: %s" % (dtype, output_dir))
+            for key in sorted(report):
+                print ("%s: %s" % (key, report[key]))
+        return report
+
+    def quantization_report(self, quantized):
+        """Compare the outputs of a quantized Brain with this one on every training sentence.
+
+        Reports the accuracy of both against the training labels, how often
+        they agree on the top class and on the classes above error_threshold,
+        the largest and mean absolute difference of their outputs and the
+        bytes taken by their synapses.
+        """
+        records = list(self.iter_training_data())
+        sentences = [record['sentence'] for record in records]
+        class_index = {c: i for i, c in enumerate(self.classes)}
+        expected = np.array([class_index.get(record['class'], -1) for record in records])
+        outputs = self.think_batch(sentences).astype(np.float64)
+        quantized_outputs = quantized.think_batch(sentences).astype(np.float64)
+        error = np.abs(outputs - quantized_outputs)
+        return {
+            'dtype': quantized.model['quantization']['dtype'],
+            'sentences': len(sentences),
+            'accuracy': float(np.mean(np.argmax(outputs, axis=1) == expected)),
+            'quantized_accuracy': float(np.mean(np.argmax(quantized_outputs, axis=1) == expected)),
+            'top_class_agreement': float(np.mean(np.argmax(outputs, axis=1) == np.argmax(quantized_outputs, axis=1))),
+            'threshold_agreement': float(np.mean(np.all((outputs > self.error_threshold) ==
+                                                        (quantized_outputs > self.error_threshold), axis=1))),
+            'max_abs_error': float(error.max()) if error.size else 0.0,
+            'mean_abs_error': float(error.mean()) if error.size else 0.0,
+            'bytes': model_nbytes(self.model),
+            'quantized_bytes': model_nbytes(quantized.model),
+        }
+
+    ######################################################
+    # Model
+
+    def load(self, version=None):
+        """Load the model from model_dir, importing a legacy synapses.json once.
+
+        version picks one of registry.versions() instead of the saved model.
+        """
+        start_time = time.time()
+        synapse_file = os.path.join(os.path.dirname(self.model_dir), SYNAPSE_FILE)
+        if not os.path.exists(os.path.join(self.model_dir, MODEL_MANIFEST)) and os.path.exists(synapse_file):
+            convert_synapses_json(synapse_file, self.model_dir)
+            print ("converted", synapse_file, "to:", self.model_dir)
+        model = self.registry.activate(version)
+        self.load_time = time.time() - start_time
+        return model
+
+    def watch(self, interval=MODEL_POLL_INTERVAL):
+        """Swap in every newly saved model from a background thread, see ModelRegistry."""
+        self.registry.watch(interval)
+
+    @property
+    def model(self):
+        # taken once per call, so a swap never mixes two models in one result
+        model = self.registry.current
+        if model is None:
+            model = self.load()
+        return model
+
+    @property
+    def words(self):
+        return self.model['words']
+
+    @property
+    def classes(self):
+        return self.model['classes']
+
+    @property
+    def vocabulary(self):
+        return self.model['vocabulary']
+
+    @property
+    def synapse_0(self):
+        return self.model['synapse0']
+
+    @property
+    def synapse_1(self):
+        return self.model['synapse1']
+
+    def think(self, sentence, show_details=False):
+        model = self.model
+        x = bow(sentence.lower(), model['vocabulary'], show_details, sparse=True)
+        if show_details:
+            print ("sentence:", sentence, "\n bow:", model['vocabulary'].from_indices([x])[0])
+        # input layer is our bag of words, only its active rows of synapse0 are read
+        return self._think_columns(model, [x])[0]
+
+    def classify(self, sentence, show_details=False, show_classifications=True):
+        instrumented = instrumentation.enabled
+        if instrumented:
+            start = lap = time.perf_counter()
+        model = self.model
+        classes = model['classes']
+
+        # tokenize, stem and vectorize like bow(), one stage at a time
+        sentence_words = tokenize("string", sentence.lower())
+        if instrumented:
+            lap = instrumentation.lap('classify.tokenize_seconds', lap)
+        sentence_words = [stemmer.stem(word.lower()) for word in sentence_words]
+        if instrumented:
+            lap = instrumentation.lap('classify.stem_seconds', lap)
+        columns = model['vocabulary'].vectorize(sentence_words, sparse=True)
+        if instrumented:
+            lap = instrumentation.lap('classify.bow_seconds', lap)
+            instrumentation.observe('classify.tokens', len(sentence_words))
+            instrumentation.observe('classify.vocabulary_hits', len(columns))
+        if show_details:
+            for i in columns:
+                print ("found in bag: %s" % model['vocabulary'].name(i))
+
+        key = (tuple(columns.tolist()), self.error_threshold, None)
+        return_results = self.result_cache.get(key, model['checksum'])
+        if instrumented:
+            instrumentation.count('classify.cache_hits' if return_results is not None else 'classify.cache_misses')
+
+        if return_results is None:
+            results = self._think_columns(model, [columns], 'classify')
+            if instrumented:
+                lap = time.perf_counter()
+
+            return_results = [[classes[c], score] for c, score in top_classes(results, self.error_threshold)[0]]
+            self.result_cache.put(key, return_results, model['checksum'])
+            if instrumented:
+                instrumentation.lap('classify.sort_seconds', lap)
+        # callers get their own lists, the cached ones stay untouched
+        return_results = [list(r) for r in return_results]
+        if instrumented:
+            instrumentation.lap('classify.seconds', start)
+        if show_classifications: print("%s \n classification: %s" % (sentence, return_results))
+        return return_results
+
+    @property
+    def entity_matcher(self):
+        if self._entity_matcher is None:
+            self._entity_matcher = EntityMatcher(self.dictionary)
+        return self._entity_matcher
+
+    def classify_entities(self, sentence, show_details=False, show_classifications=True):
+        """Return the classify() results of sentence and the dictionary entities found in it."""
+        return_results = self.classify(sentence, show_details, False)
+        entities = self.entity_matcher.match(sentence)
+        if show_classifications: print("%s \n classification: %s\n entities: %s" % (sentence, return_results, entities))
+        return return_results, entities
+
+    ######################################################
+    # Nearest examples
+
+    def build_example_index(self):
+        """Index the corpus by stem and save it next to the model in model_dir, see ExampleIndex.
+
+        With a dataset cache the index is kept under the dataset key, so an
+        unchanged corpus is not tokenized again.
+        """
+        key = index = None
+        if self.dataset_cache_dir:
+            key = self.dataset_key()
+            index = load_example_index(self.dataset_cache_dir, key)
+        if index is None:
+            # with a cache key the loaded corpus may be older than the training file
+            if self._corpus is not None and key is None:
+                documents = self._corpus['documents']
+            else:
+                documents = ((tokenize('string', record['sentence']), record['class']) for record in self.iter_training_data())
+            index = ExampleIndex.build(documents, key)
+            if key is not None:
+                self._save_example_index(index)
+        index.save(os.path.join(self.model_dir, EXAMPLE_INDEX_FILE))
+        self._example_index = None
+        return index
+
+    def _save_example_index(self, index):
+        if not os.path.isdir(self.dataset_cache_dir):
+            os.makedirs(self.dataset_cache_dir)
+        index.save(example_index_path(self.dataset_cache_dir, index.key))
+        trim_cache(self.dataset_cache_dir)
+
+    @property
+    def example_index(self):
+        """The ExampleIndex in model_dir, None when there is none.
+
+        It is read on first use and again once the file is replaced, but
+        never built here: training builds it, see build_example_index().
+        """
+        path = os.path.join(self.model_dir, EXAMPLE_INDEX_FILE)
+        try:
+            stat = os.stat(path)
+            stamp = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            stamp = None
+        if self._example_index is None or self._example_index[0] != stamp:
+            index = None
+            if stamp is not None:
+                try:
+                    index = ExampleIndex.load(path)
+                except (IOError, ValueError, KeyError):
+                    pass
+            self._example_index = (stamp, index)
+        return self._example_index[1]
+
+    def nearest_examples(self, sentence, k=NEAREST_K):
+        """Return the k training examples most similar to sentence, see ExampleIndex.search().
+
+        There are none without an example index in model_dir.
+        """
+        index = self.example_index
+        if index is None:
+            return []
+        return index.search(clean_up_sentence(sentence), k)
+
+    def fallback(self, sentence, k=NEAREST_K):
+        """Return classify() style [class, score] pairs from the nearest training examples.
+
+        For sentences with no class above the threshold: every class among
+        the k nearest examples is scored by its most similar example.
+        """
+        scores = {}
+        for example in self.nearest_examples(sentence, k):
+            scores.setdefault(example['class'], example['score'])
+        return [[c, score] for c, score in scores.items()]
+
+    def _think_columns(self, model, columns_list, stage='think'):
+        instrumented = instrumentation.enabled
+        if instrumented:
+            lap = time.perf_counter()
+        quantization = model.get('quantization')
+        activation = output_layer(model.get('output', 'sigmoid'))
+        # input layer is one sparse bag of words row per list of active columns
+        l0 = SparseBags.from_indices(columns_list, len(model['vocabulary']), model['vocabulary'])
+        if quantization is None:
+            # one gather per layer for the whole batch
+            l1 = sigmoid(l0.dot(model['synapse0']))
+        else:
+            l1 = l0.dot(model['synapse0'], np.float32)
+            if 'scales' in quantization:
+                l1 *= model['scales'][0]
+            l1 = sigmoid(l1)
+        if instrumented:
+            lap = instrumentation.lap(stage + '.layer_1_seconds', lap)
+        if quantization is None:
+            l2 = activation(np.dot(l1, model['synapse1']))
+        else:
+            l2 = activation(np.dot(l1, model['synapse1_float32']))
+        if instrumented:
+            instrumentation.lap(stage + '.layer_2_seconds', lap)
+        return l2
+
+    def think_batch(self, sentences):
+        model = self.model
+        vocabulary = model['vocabulary']
+        return self._think_columns(
+            model, [vocabulary.indices(clean_up_sentence(sentence.lower())) for sentence in sentences])
+
+    def classifier(self):
+        """Return the immutable Classifier of the model in use, to share between threads."""
+        model = self.model
+        classifier = model.get('classifier')
+        if classifier is None or classifier.error_threshold != self.error_threshold:
+            classifier = model['classifier'] = Classifier(model, self.error_threshold)
+        return classifier
+
+    def classify_parallel(self, sentences, threads=None, threshold=None, top_k=None, chunk_size=PARALLEL_CHUNK_SIZE):
+        """Classify many sentences over a thread pool, see Classifier.classify_parallel()."""
+        return self.classifier().classify_parallel(sentences, threads, threshold, top_k, chunk_size)
+
+    def classify_batch(self, sentences, threshold=None, top_k=None, chunk_size=BATCH_CHUNK_SIZE):
+        """Classify many sentences, returning one classify() style result per sentence.
+
+        Sentences may be any iterable; they are vectorized and fed forward
+        chunk_size at a time so memory stays bounded. Only classes above
+        threshold (error_threshold by default) are kept, at most top_k of
+        them when top_k is given. Sentences found in the result cache skip
+        the forward pass.
+        """
+        threshold = self.error_threshold if threshold is None else threshold
+        model = self.model
+        classes = model['classes']
+        vocabulary = model['vocabulary']
+        cache = self.result_cache
+        sentences = iter(sentences)
+        return_results = []
+        while True:
+            chunk = list(itertools.islice(sentences, chunk_size))
+            if not chunk:
+                break
+            instrumented = instrumentation.enabled
+            if instrumented:
+                lap = time.perf_counter()
+                instrumentation.observe('classify_batch.sentences', len(chunk))
+            columns_list = [vocabulary.indices(clean_up_sentence(sentence.lower())) for sentence in chunk]
+            keys = [(tuple(columns.tolist()), threshold, top_k) for columns in columns_list]
+            chunk_results = [cache.get(key, model['checksum']) for key in keys]
+            missing = [i for i, result in enumerate(chunk_results) if result is None]
+            if instrumented:
+                lap = instrumentation.lap('classify_batch.bow_seconds', lap)
+                instrumentation.count('classify_batch.cache_hits', len(chunk) - len(missing))
+                instrumentation.count('classify_batch.cache_misses', len(missing))
+
+            if missing:
+                results = self._think_columns(model, [columns_list[i] for i in missing], 'classify_batch')
+                if instrumented:
+                    lap = time.perf_counter()
+
+                for i, pairs in zip(missing, top_classes(results, threshold, top_k)):
+                    chunk_results[i] = [[classes[c], score] for c, score in pairs]
+                    cache.put(keys[i], chunk_results[i], model['checksum'])
+                if instrumented:
+                    instrumentation.lap('classify_batch.sort_seconds', lap)
+
+            return_results.extend([list(r) for r in result] for result in chunk_results)
+        return return_results
+
+    def __repr__(self):
+        return '<Brain %s>' % self.model_dir
+
+# the default brain, used by the module level functions below
+brain = Brain()
+
+def think(sentence, show_details=False):
+    return brain.think(sentence, show_details)
 
 def classify(sentence, show_details=False, show_classifications=True):
-    results = think(sentence, show_details)
-
-    results = [[i,r] for i,r in enumerate(results) if r>ERROR_THRESHOLD ] 
-    results.sort(key=lambda x: x[1], reverse=True) 
-    return_results =[[classes[r[0]],r[1]] for r in results]
-    if show_classifications: print("%s \n classification: %s" % (sentence, return_results))
-    return return_results
-
-classify("sudo make me a sandwich", show_classifications=False)
-classify("how are you today?", show_classifications=False)
-classify("talk to you tomorrow", show_classifications=False)
-classify("who are you?", show_classifications=False)
-classify("make me some lunch", show_classifications=False)
-classify("how was your lunch today?", show_classifications=False)
-print()
-classify("who are you?", show_classifications=False)
-classify("have a good day! idiot")
+    return brain.classify(sentence, show_details, show_classifications)
+
+def classify_batch(sentences, threshold=ERROR_THRESHOLD, top_k=None, chunk_size=BATCH_CHUNK_SIZE):
+    return brain.classify_batch(sentences, threshold, top_k, chunk_size)
+
+def classify_parallel(sentences, threads=None, threshold=ERROR_THRESHOLD, top_k=None, chunk_size=PARALLEL_CHUNK_SIZE):
+    return brain.classify_parallel(sentences, threads, threshold, top_k, chunk_size)
+
+def nearest_examples(sentence, k=NEAREST_K):
+    return brain.nearest_examples(sentence, k)
+######################################################
+# Classification server
+#
+# A small HTTP/1.1 server on asyncio streams, over TCP or a Unix socket.
+# Concurrent requests are queued and coalesced into micro-batches so a
+# single classify_batch forward pass serves many of them.
+#
+#   POST /classify  {"sentence": "..."} or {"sentences": ["...", ...]}
+#   GET  /health
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                413: 'Payload Too Large', 503: 'Service Unavailable'}
+
+class ClassificationServer(object):
+    """Serves brain.classify_batch over HTTP with asyncio micro-batching.
+
+    Up to max_batch_size queued sentences are classified together, waiting
+    at most max_wait seconds for a batch to fill. When max_queue sentences
+    are already waiting new requests are refused with 503.
+    """
+
+    # largest request body accepted, in bytes
+    max_body_size = 1 << 20
+    # seconds a connection may take to send each line or body of a request, or stay idle
+    read_timeout = 30.0
+    # seconds stop() waits for requests being handled before cancelling them
+    shutdown_timeout = 5.0
+
+    def __init__(self, brain=brain, host='127.0.0.1', port=8000, path=None,
+                 max_batch_size=64, max_wait=0.005, max_queue=1024):
+        self.brain = brain
+        self.host = host
+        self.port = port
+        self.path = path
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.requests = 0
+        self.batches = 0
+        self.rejected = 0
+        self._server = None
+        self._queue = None
+        self._worker = None
+        self._executor = None
+        self._connections = set()
+        self._busy = set()
+        # connection handler tasks, cancelled by stop() when they outlive shutdown_timeout
+        self._handlers = set()
+        self._stopping = False
+
+    async def start(self):
+        """Load the model and start listening and batching."""
+        loop = asyncio.get_running_loop()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        await loop.run_in_executor(self._executor, lambda: self.brain.model)
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.ensure_future(self._batch_worker())
+        if self.path:
+            self._server = await asyncio.start_unix_server(self._handle_connection, path=self.path)
+        else:
+            self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+            # report the real port when an ephemeral one was asked for
+            self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self, timeout=None):
+        """Stop accepting connections, answer every queued sentence, then shut down.
+
+        New requests are refused with 503. Requests still being handled
+        after timeout seconds, shutdown_timeout by default, are cancelled.
+        """
+        if self._server is None:
+            return
+        loop = asyncio.get_running_loop()
+        self._stopping = True
+        self._server.close()
+        await self._queue.put(None)
+        await self._worker
+        # let the answered requests be written, then drop the idle keep-alive connections
+        deadline = loop.time() + (self.shutdown_timeout if timeout is None else timeout)
+        while self._busy and loop.time() < deadline:
+            await asyncio.sleep(0.001)
+        for task in list(self._handlers):
+            task.cancel()
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+        for writer in list(self._connections):
+            writer.close()
+        await self._server.wait_closed()
+        self._executor.shutdown(wait=True)
+        self._server = None
+
+    async def classify(self, sentences):
+        """Queue sentences for the next batches and wait for their results."""
+        if self._stopping:
+            # the batch worker is gone or about to go
+            raise RuntimeError("The server is shutting down")
+        if self._queue.qsize() + len(sentences) > self.max_queue:
+            self.rejected += 1
+            raise OverflowError("The classification queue is full")
+        loop = asyncio.get_running_loop()
+        futures = []
+        for sentence in sentences:
+            future = loop.create_future()
+            self._queue.put_nowait((sentence, future))
+            futures.append(future)
+        return await asyncio.gather(*futures)
+
+    async def _batch_worker(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                if self._queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    item = self._queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            sentences = [sentence for sentence, future in batch]
+            try:
+                results = await loop.run_in_executor(self._executor, self.brain.classify_batch, sentences)
+            except Exception as error:
+                for sentence, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+            else:
+                for (sentence, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result([[c, float(p)] for c, p in result])
+            self.batches += 1
+
+    async def _handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._handlers.add(task)
+        self._connections.add(writer)
+        try:
+            keep_alive = True
+            while keep_alive:
+                request_line = await asyncio.wait_for(reader.readline(), self.read_timeout)
+                if not request_line:
+                    break
+                self._busy.add(writer)
+                headers = {}
+                while True:
+                    line = await asyncio.wait_for(reader.readline(), self.read_timeout)
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = headers.get('connection', '').lower() != 'close' and not self._stopping
+
+                parts = request_line.decode('latin-1').split()
+                try:
+                    length = int(headers.get('content-length', 0) or 0)
+                except ValueError:
+                    length = -1
+                if len(parts) < 2 or length < 0:
+                    status, body = 400, {'error': 'bad request'}
+                    keep_alive = False
+                elif length > self.max_body_size:
+                    status, body = 413, {'error': 'request body too large'}
+                    keep_alive = False
+                else:
+                    payload = await asyncio.wait_for(reader.readexactly(length), self.read_timeout) if length else b''
+                    status, body = await self._respond(parts[0], parts[1], payload)
+                    if self._stopping:
+                        keep_alive = False
+
+                data = json.dumps(body).encode('utf-8')
+                writer.write(('HTTP/1.1 %s %s\r\nContent-Type: application/json\r\n'
+                              'Content-Length: %s\r\nConnection: %s\r\n\r\n' % (
+                                  status, HTTP_REASONS[status], len(data),
+                                  'keep-alive' if keep_alive else 'close')).encode('latin-1') + data)
+                await writer.drain()
+                self._busy.discard(writer)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            # cancelled by stop(), the task ends here either way
+            pass
+        finally:
+            self._busy.discard(writer)
+            self._connections.discard(writer)
+            self._handlers.discard(task)
+            writer.close()
+
+    async def _respond(self, method, target, payload):
+        if target == '/health':
+            return 200, {'status': 'ok', 'model': self.brain.model['datetime'],
+                         'queue': self._queue.qsize(), 'requests': self.requests,
+                         'batches': self.batches, 'rejected': self.rejected}
+        if target != '/classify':
+            return 404, {'error': 'not found'}
+        if method != 'POST':
+            return 405, {'error': 'use POST'}
+        try:
+            request = json.loads(payload.decode('utf-8'))
+            single = 'sentence' in request
+            sentences = [request['sentence']] if single else list(request['sentences'])
+            if not all(isinstance(sentence, str) for sentence in sentences):
+                raise TypeError
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return 400, {'error': 'expected {"sentence": "..."} or {"sentences": [...]}'}
+        try:
+            results = await self.classify(sentences)
+        except (OverflowError, RuntimeError) as error:
+            return 503, {'error': str(error)}
+        self.requests += 1
+        if single:
+            return 200, {'sentence': sentences[0], 'classification': results[0]}
+        return 200, {'classifications': results}
+
+    def __repr__(self):
+        return '<ClassificationServer %s>' % (self.path or '%s:%s' % (self.host, self.port))
+
+def serve(**kwargs):
+    """Run a ClassificationServer until SIGINT or SIGTERM, then shut it down gracefully."""
+    async def run():
+        server = await ClassificationServer(**kwargs).start()
+        print ("serving on", server)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        await stop.wait()
+        print ("shutting down")
+        await server.stop()
+    asyncio.run(run())
+
+######################################################
+# Bulk classification
+#
+# Sentences are read one line at a time and classified chunk_size lines
+# at a time, so memory stays flat whatever the size of the input.
+
+# class reported for sentences with no class above the threshold
+UNKNOWN_CLASS = 'unknown'
+
+def classify_stream(lines, brain=brain, top_k=3, threshold=None, chunk_size=BATCH_CHUNK_SIZE, threads=None,
+                    fallback=False):
+    """Yield one result dict per line: its number, sentence, top class and classifications.
+
+    The class is UNKNOWN_CLASS when no class scores above threshold, unless
+    fallback is set and a training example shares a stem with the sentence:
+    then the classes of the nearest examples are reported, see
+    Brain.fallback(), and the result's source is 'nearest' instead of
+    'network'. With threads the chunks are classified by
+    Brain.classify_parallel().
+    """
+    numbered = enumerate((line.rstrip('\r\n') for line in lines), 1)
+    while True:
+        chunk = list(itertools.islice(numbered, chunk_size))
+        if not chunk:
+            return
+        sentences = [sentence for number, sentence in chunk]
+        if threads:
+            results = brain.classify_parallel(sentences, threads, threshold, top_k)
+        else:
+            results = brain.classify_batch(sentences, threshold, top_k)
+        for (number, sentence), result in zip(chunk, results):
+            source = 'network'
+            if not result and fallback:
+                result = brain.fallback(sentence, top_k or NEAREST_K)
+                if result:
+                    source = 'nearest'
+            yield {'line': number,
+                   'sentence': sentence,
+                   'class': result[0][0] if result else UNKNOWN_CLASS,
+                   'source': source,
+                   'classifications': [{'class': c, 'score': float(score)} for c, score in result]}
+
+def classify_file(input_file, output_file, **kwargs):
+    """Classify every line of input_file to one JSON line of output_file, see classify_stream().
+
+    Either may be an open file or a path, '-' for stdin or stdout. Returns
+    the number of lines, how many were unknown, the seconds taken and the
+    lines per second.
+    """
+    start_time = time.time()
+    lines = unknown = 0
+    with contextlib.ExitStack() as stack:
+        if not hasattr(input_file, 'read'):
+            input_file = sys.stdin if input_file == '-' else stack.enter_context(open(input_file, errors='replace'))
+        if not hasattr(output_file, 'write'):
+            output_file = sys.stdout if output_file == '-' else stack.enter_context(open(output_file, 'w'))
+        for result in classify_stream(input_file, **kwargs):
+            output_file.write(json.dumps(result) + '\n')
+            lines += 1
+            unknown += result['class'] == UNKNOWN_CLASS
+        output_file.flush()
+    seconds = time.time() - start_time
+    return {'lines': lines, 'unknown': unknown, 'seconds': seconds,
+            'lines_per_sec': lines / seconds if seconds else float('inf')}
+
 ######################################################
 
 """Clears the console"""
@@ -619,14 +3467,72 @@ def clean():
 	else:
 		system('clear')
 
-######################################################
-# Getting input from the user
+def main():
+	parser = argparse.ArgumentParser(description='liOS Brain Core')
+	parser.add_argument('--serve', action='store_true', help='run the classification server instead of the prompt')
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=8000)
+	parser.add_argument('--socket', help='serve on this Unix socket instead of TCP')
+	parser.add_argument('--watch', type=float, metavar='SECONDS', help='swap in newly trained models, looking every SECONDS')
+	parser.add_argument('--classify', metavar='FILE', help='classify every line of FILE (- for stdin) to JSON lines instead of the prompt')
+	parser.add_argument('--output', default='-', help='where --classify writes, stdout by default')
+	parser.add_argument('--top-k', type=int, default=3, help='classes reported per line by --classify')
+	parser.add_argument('--threshold', type=float, help='score a class needs to be reported, %s by default' % ERROR_THRESHOLD)
+	parser.add_argument('--chunk-size', type=int, default=BATCH_CHUNK_SIZE, help='lines classified at once by --classify')
+	parser.add_argument('--threads', type=int, help='classify the chunks of --classify on this many threads')
+	parser.add_argument('--fallback', action='store_true', help='report the classes of the nearest training examples for lines with no class above the threshold')
+	args = parser.parse_args()
+	if args.watch:
+		brain.watch(args.watch)
+	if args.serve:
+		serve(host=args.host, port=args.port, path=args.socket)
+		return
+	if args.classify:
+		stats = classify_file(args.classify, args.output, top_k=args.top_k, threshold=args.threshold,
+		                      chunk_size=args.chunk_size, threads=args.threads, fallback=args.fallback)
+		# stdout may be the JSON lines
+		print ("classified %(lines)s lines (%(unknown)s unknown) in %(seconds).2f seconds, %(lines_per_sec).1f lines/sec" % stats,
+		       file=sys.stderr)
+		return
 
-# Create a while loop to keep the program running
-while True:
-	user_input = input(">>> ")
-	classified_input = classify(user_input, show_classifications=True)
-	
-	while len(classified_input) == 0:
+	######################################################
+	# Training
+	start_time = time.time()
+
+	#brain.train(hidden_neurons=20, alpha=0.1, epochs=100000, dropout=False, dropout_percent=0.2)
+
+	elapsed_time = time.time() - start_time
+	print("\nTraining results")
+	print ("processing time:", elapsed_time, "seconds")
+	######################################################
+
+	brain.load()
+	print ("model load time:", brain.load_time, "seconds, target:", COLD_START_TARGET)
+
+	classify("sudo make me a sandwich", show_classifications=False)
+	classify("how are you today?", show_classifications=False)
+	classify("talk to you tomorrow", show_classifications=False)
+	classify("who are you?", show_classifications=False)
+	classify("make me some lunch", show_classifications=False)
+	classify("how was your lunch today?", show_classifications=False)
+	print()
+	classify("who are you?", show_classifications=False)
+	classify("have a good day! idiot")
+
+	######################################################
+	# Getting input from the user
+
+	# Create a while loop to keep the program running
+	while True:
+		user_input = input(">>> ")
 		classified_input = classify(user_input, show_classifications=True)
-	print(classified_input[0][0])
+		
+		# asking again would give the same answer, look for similar training examples instead
+		if not classified_input:
+			classified_input = brain.fallback(user_input)
+			if classified_input:
+				print("nearest examples:", classified_input)
+		print(classified_input[0][0] if classified_input else UNKNOWN_CLASS)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,249 @@
+"""Benchmarks of the liOS Brain Core pipeline.
+
+Every stage of Core.py is timed on synthetic corpora of several vocabulary
+and class sizes:
+
+    stem        liOS_Stemmer.stem throughput, cold and cached
+    tokenize    tokenize('string', ...) throughput, and that of the original
+                split-on-spaces tokenizer as tokenize_legacy
+    tokenize_file  tokenize('file', ...) streaming word frequency throughput
+    bow         bag of words vectorization throughput, and that of a
+                HashingVocabulary with bigrams as bow_hashing
+    think       single sentence think() latency (p50/p99)
+    classify    single sentence classify() latency (p50/p99), uncached
+    nearest     single sentence nearest_examples() latency (p50/p99) on the
+                inverted index of the training examples
+    classify_batch  classify_batch() throughput of the float64 model, and of
+                its int8 and float16 quantized copies
+    classify_parallel_N  Classifier.classify_parallel() throughput on N threads,
+                for every N of --threads
+    train       full-batch training throughput in epochs/sec, and that of a
+                softmax output layer as train_softmax
+    load        model load time
+    dataset     Brain.dataset() time with an empty dataset cache, and with
+                the cache filled as dataset_cached
+
+Results are written as JSON. Given a baseline file from an earlier run,
+every metric that got worse by more than the tolerance is reported as a
+regression and the exit status is 1.
+
+    python benchmark.py --output bench.json
+    python benchmark.py --baseline bench.json --tolerance 0.2
+"""
+from __future__ import print_function
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import string
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import Core
+
+# corpus name -> (vocabulary size, number of classes, sentences per class)
+CORPORA = {
+    'small': (300, 5, 20),
+    'medium': (3000, 30, 20),
+    'large': (15000, 100, 10),
+    'intents': (20000, 2000, 3),
+}
+
+# metrics where a lower value is better, every other metric is a throughput
+LOWER_IS_BETTER = ('p50_us', 'p99_us', 'seconds')
+
+def legacy_tokenize(content):
+    """The tokenize('string', ...) of earlier releases, kept as a reference point."""
+    final_content = content.split(' ')
+    for words in content:
+        words.replace(string.punctuation,'')
+    return final_content
+
+def synthetic_corpus(vocabulary_size, class_count, per_class, seed=1):
+    """Return training records whose words are drawn mostly from their class' share of a random vocabulary."""
+    rnd = random.Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    vocabulary = set()
+    while len(vocabulary) < vocabulary_size:
+        vocabulary.add(''.join(rnd.choice(letters) for _ in range(rnd.randint(3, 10))))
+    vocabulary = sorted(vocabulary)
+
+    share = max(1, vocabulary_size // class_count)
+    records = []
+    for c in range(class_count):
+        class_words = vocabulary[c * share:(c + 1) * share] or vocabulary
+        for _ in range(per_class):
+            words = [rnd.choice(class_words) if rnd.random() < 0.8 else rnd.choice(vocabulary)
+                     for _ in range(rnd.randint(3, 10))]
+            records.append({'id': '', 'class': 'class%s' % c, 'sentence': ' '.join(words)})
+    return records
+
+def throughput(function, items, repeat=3):
+    """Return the best items per second of calling function on every item."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            function(item)
+        best = min(best, time.perf_counter() - start)
+    return {'ops_per_sec': len(items) / best if best else float('inf')}
+
+def latency(function, items):
+    """Return the p50 and p99 latency of calling function on every item, in microseconds."""
+    timings = []
+    for item in items:
+        start = time.perf_counter()
+        function(item)
+        timings.append(time.perf_counter() - start)
+    timings = np.array(timings) * 1e6
+    return {'p50_us': float(np.percentile(timings, 50)), 'p99_us': float(np.percentile(timings, 99))}
+
+def bench_corpus(name, vocabulary_size, class_count, per_class, epochs=50, seed=1, threads=(1, 2, 4)):
+    records = synthetic_corpus(vocabulary_size, class_count, per_class, seed)
+    sentences = [record['sentence'] for record in records]
+    tokens = [w for sentence in sentences for w in sentence.split(' ')]
+
+    directory = tempfile.mkdtemp(prefix='lios-bench-')
+    try:
+        training_file = os.path.join(directory, 'training_data.json')
+        with open(training_file, 'w') as outfile:
+            json.dump({'dataObjects': records}, outfile)
+        brain = Core.Brain(training_file, os.path.join(directory, 'synapses'), cache_size=0)
+        brain.load_training_data()
+        X, y = brain.training_set()
+        vocabulary = Core.Vocabulary(brain.corpus['words'])
+
+        results = {'corpus': {'words': len(vocabulary), 'classes': len(brain.corpus['classes']),
+                              'sentences': len(records)}}
+        results['stem'] = throughput(Core.liOS_Stemmer(cache_size=0).stem, tokens)
+        cached_stemmer = Core.liOS_Stemmer()
+        results['stem_cached'] = throughput(cached_stemmer.stem, tokens)
+        results['tokenize'] = throughput(lambda sentence: Core.tokenize('string', sentence), sentences)
+        results['tokenize_legacy'] = throughput(legacy_tokenize, sentences)
+        text_file = os.path.join(directory, 'sentences.txt')
+        with open(text_file, 'w') as outfile:
+            outfile.write('\n'.join(sentences * 10))
+        results['tokenize_file'] = throughput(lambda path: Core.tokenize('file', path), [text_file])
+        results['tokenize_file']['tokens_per_sec'] = results['tokenize_file'].pop('ops_per_sec') * len(tokens) * 10
+        cache_dir = os.path.join(directory, 'dataset_cache')
+        for stage in ('dataset', 'dataset_cached'):
+            start = time.perf_counter()
+            Core.Brain(training_file, dataset_cache_dir=cache_dir).dataset()
+            results[stage] = {'seconds': time.perf_counter() - start}
+        results['bow'] = throughput(lambda sentence: Core.bow(sentence, vocabulary), sentences)
+        hashing = Core.HashingVocabulary(ngrams=2)
+        results['bow_hashing'] = throughput(lambda sentence: Core.bow(sentence, hashing), sentences)
+
+        np.random.seed(seed)
+        start = time.perf_counter()
+        synapse_0, synapse_1 = Core.train_synapses(X, y, hidden_neurons=20, alpha=0.1, epochs=epochs, verbose=False)
+        results['train'] = {'epochs_per_sec': (epochs + 1) / (time.perf_counter() - start)}
+        start = time.perf_counter()
+        Core.train_synapses(X, y, hidden_neurons=20, alpha=0.1, epochs=epochs, verbose=False, output='softmax')
+        results['train_softmax'] = {'epochs_per_sec': (epochs + 1) / (time.perf_counter() - start)}
+
+        Core.save_model(brain.model_dir, synapse_0, synapse_1, brain.corpus['words'], brain.corpus['classes'])
+        loads = []
+        for _ in range(5):
+            start = time.perf_counter()
+            Core.load_model(brain.model_dir)
+            loads.append(time.perf_counter() - start)
+        results['load'] = {'seconds': min(loads)}
+
+        brain.load()
+        results['think'] = latency(brain.think, sentences)
+        results['classify'] = latency(lambda sentence: brain.classify(sentence, show_classifications=False), sentences)
+        brain.build_example_index()
+        results['nearest'] = latency(brain.nearest_examples, sentences)
+        results['classify_batch'] = throughput(brain.classify_batch, [sentences])
+        for dtype in Core.QUANTIZE_DTYPES:
+            quantized_dir = os.path.join(directory, 'synapses-' + dtype)
+            Core.quantize_model(brain.model_dir, quantized_dir, dtype)
+            quantized = Core.Brain(training_file, quantized_dir, cache_size=0)
+            quantized.load()
+            results['classify_batch_' + dtype] = throughput(quantized.classify_batch, [sentences])
+        classifier = brain.classifier()
+        workload = sentences * 20
+        for count in threads:
+            results['classify_parallel_%s' % count] = throughput(
+                lambda sentences: classifier.classify_parallel(sentences, threads=count), [workload])
+            results['classify_parallel_%s' % count]['ops_per_sec'] *= 20
+        for stage in results:
+            if stage.startswith(('classify_batch', 'classify_parallel')):
+                results[stage]['sentences_per_sec'] = results[stage].pop('ops_per_sec') * len(sentences)
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+def flatten(results):
+    """Return {'corpus.stage.metric': value} for every timed metric."""
+    flat = {}
+    for corpus, stages in results.items():
+        for stage, metrics in stages.items():
+            if stage == 'corpus':
+                continue
+            for metric, value in metrics.items():
+                flat['%s.%s.%s' % (corpus, stage, metric)] = value
+    return flat
+
+def compare(results, baseline, tolerance=0.2):
+    """Return a (metric, baseline, current, change) tuple for every regression beyond tolerance."""
+    current = flatten(results)
+    regressions = []
+    for metric, base in sorted(flatten(baseline).items()):
+        if metric not in current or not base:
+            continue
+        change = (current[metric] - base) / base
+        worse = change > tolerance if metric.endswith(LOWER_IS_BETTER) else change < -tolerance
+        if worse:
+            regressions.append((metric, base, current[metric], change))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the liOS Brain Core pipeline')
+    parser.add_argument('--corpora', default='small,medium', help='comma separated names from: %s' % ', '.join(sorted(CORPORA)))
+    parser.add_argument('--epochs', type=int, default=50, help='epochs timed for training throughput')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--threads', default='1,2,4', help='comma separated thread counts of classify_parallel')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare against the results in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative change counted as a regression')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name in args.corpora.split(','):
+        print ("benchmarking %s corpus..." % name)
+        results[name] = bench_corpus(name, *CORPORA[name], epochs=args.epochs, seed=args.seed,
+                                     threads=[int(count) for count in args.threads.split(',')])
+        for stage, metrics in sorted(results[name].items()):
+            print ("  %-12s %s" % (stage, ', '.join('%s=%.6g' % item for item in sorted(metrics.items()))))
+
+    report = {'meta': {'datetime': datetime.datetime.now().strftime("%Y-%m-%d %H:%M"),
+                       'python': platform.python_version(), 'numpy': np.__version__,
+                       'platform': platform.platform(), 'seed': args.seed, 'epochs': args.epochs,
+                       'cpus': os.cpu_count()},
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(report, outfile, indent=4, sort_keys=True)
+        print ("saved results to:", args.output)
+
+    if args.baseline:
+        with open(args.baseline) as data_file:
+            baseline = json.load(data_file)
+        regressions = compare(results, baseline['results'], args.tolerance)
+        for metric, base, value, change in regressions:
+            print ("REGRESSION %s: %.6g -> %.6g (%+.1f%%)" % (metric, base, value, change * 100))
+        if regressions:
+            return 1
+        print ("no regressions against", args.baseline)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,306 @@
+"""Tests of Core.py.
+
+    python -m unittest test_core
+"""
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import unittest.mock
+
+import numpy as np
+
+import Core
+
+# imports Core from the repository with the current directory as its data
+# directory and prints every file system access under it, as JSON
+IMPORT_PROBE = '''
+import json, os, sys
+data_dir = os.path.realpath(os.getcwd())
+touched = []
+def audit(event, args):
+    if event in ('open', 'os.listdir', 'os.scandir', 'os.mkdir', 'os.remove', 'os.rename', 'os.replace'):
+        path = args[0]
+        if isinstance(path, bytes):
+            path = os.fsdecode(path)
+        if isinstance(path, str) and os.path.realpath(os.path.abspath(path or '.')).startswith(data_dir):
+            touched.append([event, path])
+sys.addaudithook(audit)
+sys.path.insert(0, %r)
+import Core
+sys.stdout.write(json.dumps(touched))
+'''
+
+def save_random_model(model_dir, words, classes, hidden_neurons=20, seed=1):
+    random_state = np.random.RandomState(seed)
+    synapse_0 = 2*random_state.random_sample((len(words), hidden_neurons)) - 1
+    synapse_1 = 2*random_state.random_sample((hidden_neurons, len(classes))) - 1
+    return Core.save_model(model_dir, synapse_0, synapse_1, words, classes)
+
+class ImportTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='lios-test-')
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def probe(self):
+        probe = IMPORT_PROBE % os.path.dirname(os.path.abspath(__file__))
+        output = subprocess.check_output([sys.executable, '-I', '-c', probe], cwd=self.directory)
+        # anything printed by the import would break the JSON
+        return json.loads(output.decode('utf-8'))
+
+    def test_import_without_data(self):
+        self.assertEqual(self.probe(), [])
+
+    def test_import_reads_nothing(self):
+        # neither the corpus, the dictionary nor the model are touched until used
+        shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), Core.DICTIONARY_FILE), self.directory)
+        with open(os.path.join(self.directory, Core.TRAINING_FILE), 'w') as outfile:
+            json.dump({'dataObjects': [{'id': '', 'class': 'greeting', 'sentence': 'hello there'}]}, outfile)
+        save_random_model(os.path.join(self.directory, Core.MODEL_DIR), ['hello', 'ther'], ['greeting'])
+        self.assertEqual(self.probe(), [])
+
+class ColdStartTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='lios-test-')
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.model_dir = os.path.join(self.directory, 'synapses')
+        # the size of a large corpus: 15000 stems, 100 classes
+        self.words = ['w%05d' % i for i in range(15000)]
+        self.classes = ['class%s' % i for i in range(100)]
+        save_random_model(self.model_dir, self.words, self.classes)
+
+    def test_load_under_target(self):
+        timings = []
+        for _ in range(3):
+            brain = Core.Brain(os.path.join(self.directory, 'missing.json'), self.model_dir)
+            start = time.perf_counter()
+            brain.load()
+            timings.append(time.perf_counter() - start)
+        self.assertLess(min(timings), Core.COLD_START_TARGET)
+        self.assertLess(brain.load_time, Core.COLD_START_TARGET)
+
+    def test_inference_skips_training_data(self):
+        # the training file does not exist, classifying must not need it
+        brain = Core.Brain(os.path.join(self.directory, 'missing.json'), self.model_dir)
+        results = brain.classify('w00001 w00002', show_classifications=False)
+        self.assertIsInstance(results, list)
+        self.assertIsNone(brain._corpus)
+        self.assertEqual(brain.classes, self.classes)
+
+# records with decimals and exponents, which a chunk boundary can cut
+RECORDS = [
+    '{"id": 12.75, "class": "greeting", "sentence": "hello there", "weight": 3e5}',
+    '{"id": -4.5, "class": "goodbye", "sentence": "see you later", "weight": 1.5E-3}',
+    '{"id": 7, "class": "thanks", "sentence": "thank you", "weight": 0.125}',
+]
+
+class TrainingDataTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='lios-test-')
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.addCleanup(setattr, Core.json_utils, 'chunk_size', Core.json_utils.chunk_size)
+
+    def check(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w', newline='') as outfile:
+            outfile.write(text)
+        with open(path) as infile:
+            if text.startswith('{"dataObjects"') or text.startswith('{"version"'):
+                records = json.load(infile)['dataObjects']
+            else:
+                records = [json.loads(line) for line in infile if line.strip()]
+        expected = [{'id': r['id'], 'class': r['class'], 'sentence': r['sentence']} for r in records]
+        for chunk_size in range(1, 21):
+            Core.json_utils.chunk_size = chunk_size
+            self.assertEqual(Core.json_utils.get_training_data(path), expected, (name, chunk_size))
+
+    def test_json_lines(self):
+        self.check('lines.json', '\n'.join(RECORDS) + '\n')
+
+    def test_crlf_json_lines(self):
+        self.check('crlf.json', '\r\n'.join(RECORDS))
+
+    def test_data_objects_first(self):
+        self.check('first.json', '{"dataObjects": [' + ', '.join(RECORDS) + '], "version": 2.5}')
+
+    def test_data_objects_after_other_keys(self):
+        self.check('after.json', '{"version": 2.5, "scale": -1e-2, "dataObjects": [\n' + ',\n'.join(RECORDS) + '\n]}')
+
+# the prefixes the original stemmer strips with strip_prefix_flag
+PREFIXES = ('kilo', 'micro', 'milli', 'intra', 'ultra', 'mega', 'nano', 'pico', 'pseudo', 'anti', 'dis', 'ex', 'hyper')
+
+def reference_stem(word, rule_tuple, strip_prefix_flag=False):
+    """Stem word like the original stemmer did, matching every rule string with a regular expression."""
+    valid_rule = re.compile(r'^([a-z]+)(\*?)(\d)([a-z]*)([>\.]?)$')
+    rules = {}
+    for rule in rule_tuple:
+        rules.setdefault(rule[0], []).append(rule)
+    word = word.lower()
+    if strip_prefix_flag:
+        for prefix in PREFIXES:
+            if word.startswith(prefix):
+                word = word[len(prefix):]
+                break
+    intact_word = word
+
+    def acceptable(word, remove_total):
+        if word[0] in 'aeiouy':
+            return len(word) - remove_total >= 2
+        return len(word) - remove_total >= 3 and (word[1] in 'aeiouy' or word[2] in 'aeiouy')
+
+    while True:
+        last_letter = -1
+        for position, character in enumerate(word):
+            if not character.isalpha():
+                break
+            last_letter = position
+        if last_letter < 0 or word[last_letter] not in rules:
+            return word
+        for rule in rules[word[last_letter]]:
+            ending, intact_flag, remove_total, append_string, cont_flag = valid_rule.match(rule).groups()
+            remove_total = int(remove_total)
+            if not word.endswith(ending[::-1]) or (intact_flag and word != intact_word):
+                continue
+            if not acceptable(word, remove_total):
+                continue
+            word = word[:len(word) - remove_total] + append_string
+            if cont_flag == '.':
+                return word
+            break
+        else:
+            return word
+
+class StemmerTest(unittest.TestCase):
+    def words(self):
+        words = ['', 'a', 'y', 'ai', '123', 'ab1c', "it's", 'ÉCOLE', 'Hello', 'x-ray']
+        for stem in ('connect', 'nation', 'happy', 'run', 'organ', 'relate', 'agree', 'multiply', 'sing'):
+            for suffix in ('', 's', 'ing', 'ed', 'ation', 'ness', 'ly', 'ies', 'ful', 'ment', 'ability', 'izing'):
+                words.append(stem + suffix)
+                words.extend(prefix + stem + suffix for prefix in ('anti', 'dis', 'ex', 'hyper', 'micro'))
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), Core.TRAINING_FILE)) as infile:
+            words.extend(Core.tokenize('string', infile.read()))
+        random_state = random.Random(1)
+        words.extend(''.join(random_state.choice('abcdeilmnorstuy') for _ in range(random_state.randint(1, 12)))
+                     for _ in range(2000))
+        return words
+
+    def test_matches_original(self):
+        default = Core.liOS_Stemmer.default_rule_tuple
+        random_state = random.Random(2)
+        rule_tuples = [default, tuple(reversed(default)), tuple(random_state.sample(default, len(default) // 2)),
+                       ('sei3y>', 'gni3>', 'de2>', 's1>', 'noita4e.', 'ss0.', 'y1i>', 'ylb1.')]
+        words = self.words()
+        for rule_tuple in rule_tuples:
+            for strip_prefix_flag in (False, True):
+                for cache_size in (None, 0):
+                    stemmer = Core.liOS_Stemmer(rule_tuple, strip_prefix_flag, cache_size)
+                    for word in words + words:
+                        self.assertEqual(stemmer.stem(word), reference_stem(word, rule_tuple, strip_prefix_flag),
+                                         (word, strip_prefix_flag, rule_tuple[:3]))
+
+    def test_parse_rules_clears_cache(self):
+        stemmer = Core.liOS_Stemmer()
+        self.assertEqual(stemmer.stem('greetings'), 'greet')
+        rule_tuple = tuple(rule for rule in stemmer.default_rule_tuple if not rule.startswith('s'))
+        stemmer.parseRules(rule_tuple)
+        self.assertEqual(stemmer.stem('greetings'), reference_stem('greetings', rule_tuple))
+
+def random_bags(rows, width, seed=1):
+    random_state = np.random.RandomState(seed)
+    X = (random_state.random_sample((rows, width)) < 0.2).astype(int)
+    # a sentence without a known word
+    X[rows // 2] = 0
+    return X
+
+class SparseTest(unittest.TestCase):
+    def test_dot_matches_dense(self):
+        X = random_bags(40, 30)
+        synapse = np.random.RandomState(2).random_sample((30, 7)) - 0.5
+        bags = Core.SparseBags.from_dense(X)
+        np.testing.assert_allclose(bags.dot(synapse), X.dot(synapse), rtol=1e-12, atol=1e-12)
+        np.testing.assert_array_equal(bags.toarray(), X)
+        delta = np.random.RandomState(3).random_sample((40, 7)) - 0.5
+        columns, rows = bags.transpose_dot(delta)
+        np.testing.assert_array_equal(columns, np.flatnonzero(X.any(axis=0)))
+        np.testing.assert_allclose(rows, X.T.dot(delta)[columns], rtol=1e-12, atol=1e-12)
+
+    def test_train_matches_dense(self):
+        X = random_bags(40, 30)
+        y = Core.one_hot(np.arange(40) % 4, 4)
+        synapse_0, synapse_1 = Core.train_synapses(X, y, hidden_neurons=8, alpha=0.1, epochs=30, verbose=False)
+
+        # the dense full-batch gradient descent it replaces
+        np.random.seed(1)
+        dense_0 = 2*np.random.random((30, 8)) - 1
+        dense_1 = 2*np.random.random((8, 4)) - 1
+        for _ in range(31):
+            layer_1 = Core.sigmoid(np.dot(X, dense_0))
+            layer_2 = Core.sigmoid(np.dot(layer_1, dense_1))
+            layer_2_delta = (y - layer_2) * Core.sigmoid_output_to_derivative(layer_2)
+            layer_1_delta = layer_2_delta.dot(dense_1.T) * Core.sigmoid_output_to_derivative(layer_1)
+            dense_1 += 0.1 * layer_1.T.dot(layer_2_delta)
+            dense_0 += 0.1 * X.T.dot(layer_1_delta)
+        np.testing.assert_allclose(synapse_0, dense_0, rtol=1e-10, atol=1e-12)
+        np.testing.assert_allclose(synapse_1, dense_1, rtol=1e-10, atol=1e-12)
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='lios-test-')
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_resume_is_bit_for_bit(self):
+        X = random_bags(40, 30)
+        y = Core.one_hot(np.arange(40) % 4, 4)
+        # dropout draws from np.random, whose state the checkpoint restores
+        settings = dict(hidden_neurons=8, alpha=0.1, epochs=30, dropout=True, dropout_percent=0.2, verbose=False)
+        expected = Core.train_synapses(X, y, **settings)
+
+        checkpoint = os.path.join(self.directory, Core.CHECKPOINT_FILE)
+        derivative = Core.sigmoid_output_to_derivative
+        calls = []
+
+        def interrupted(output):
+            # called twice an epoch, for both layers: stop in epoch 12, after the checkpoint of epoch 10
+            calls.append(None)
+            if len(calls) == 2 * 12 + 1:
+                raise KeyboardInterrupt
+            return derivative(output)
+
+        with unittest.mock.patch.object(Core, 'sigmoid_output_to_derivative', interrupted):
+            with self.assertRaises(KeyboardInterrupt):
+                Core.train_synapses(X, y, checkpoint=checkpoint, checkpoint_every=5, **settings)
+        self.assertEqual(int(np.load(checkpoint)['epoch']), 10)
+        # np.random moves on in between, as it would in a new process
+        np.random.seed(7)
+        resumed = Core.train_synapses(X, y, checkpoint=checkpoint, checkpoint_every=5, resume=True, **settings)
+        for synapse, expected_synapse in zip(resumed, expected):
+            np.testing.assert_array_equal(synapse, expected_synapse)
+
+class TopClassesTest(unittest.TestCase):
+    def reference(self, results, threshold, top_k=None):
+        # the filter and stable sort of classify()
+        pairs = []
+        for row in results.tolist():
+            row_pairs = [[c, score] for c, score in enumerate(row) if score > threshold]
+            row_pairs.sort(key=lambda pair: pair[1], reverse=True)
+            pairs.append(row_pairs[:top_k] if top_k is not None else row_pairs)
+        return pairs
+
+    def test_matches_sort(self):
+        random_state = np.random.RandomState(1)
+        for rows, width in ((1, 5), (1, Core.TOP_CLASSES_SCAN), (1, 300), (6, 10), (9, 300)):
+            # rounded scores tie often, at the k-th place too
+            results = np.round(random_state.random_sample((rows, width)), 1)
+            for top_k in (None, 0, 1, 3, width, width + 5):
+                for threshold in (0.0, 0.5, 1.0):
+                    self.assertEqual(Core.top_classes(results, threshold, top_k),
+                                     self.reference(results, threshold, top_k), (rows, width, top_k, threshold))
+
+if __name__ == '__main__':
+    unittest.main()